@@ -0,0 +1,18 @@
+# Benchmarks for the time taken to import numtraits. Each benchmark is run in a
+# fresh interpreter, and numpy and traitlets are imported in the setup so that
+# only the time taken by numtraits itself is measured.
+
+
+class TimeImport(object):
+
+    def timeraw_import_numtraits(self):
+        return "import numtraits", "import numpy, traitlets"
+
+    def track_unit_frameworks_imported(self):
+        # Number of unit frameworks imported as a side-effect of importing
+        # numtraits, which should be zero.
+        import subprocess
+        import sys
+        code = ("import sys, numtraits; "
+                "print(sum(name in sys.modules for name in ('astropy', 'pint', 'quantities')))")
+        return int(subprocess.check_output([sys.executable, '-c', code]))
@@ -0,0 +1,83 @@
+# Benchmarks for the memory used by numerical traits when building large
+# schemas, i.e. many HasTraits classes with many numerical traits each, most of
+# which share the same few configurations.
+
+import pickle
+import tracemalloc
+
+import numpy as np
+from traitlets import HasTraits
+
+from numtraits import NumericalTrait
+
+
+def _build_schema(n_classes, n_traits):
+    classes = []
+    for i in range(n_classes):
+        traits = {}
+        for j in range(n_traits):
+            kind = j % 4
+            if kind == 0:
+                trait = NumericalTrait(ndim=0, domain='positive')
+            elif kind == 1:
+                trait = NumericalTrait(shape=(3,))
+            elif kind == 2:
+                trait = NumericalTrait(ndim=1, domain=(0., 1.))
+            else:
+                trait = NumericalTrait(ndim=2, allow_nan=False)
+            traits['trait{0}'.format(j)] = trait
+        classes.append(type('Schema{0}'.format(i), (HasTraits,), traits))
+    return classes
+
+
+class MemSchema(object):
+
+    params = [(10, 100), (100, 100), (1000, 10)]
+    param_names = ['classes, traits']
+
+    def peakmem_build_schema(self, shape):
+        _build_schema(*shape)
+
+    def track_bytes_per_trait(self, shape):
+        # Memory allocated per trait, including the share of the memory used
+        # by the classes themselves.
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            classes = _build_schema(*shape)
+            used = tracemalloc.get_traced_memory()[0] - start
+        finally:
+            tracemalloc.stop()
+        return used / (shape[0] * shape[1])
+
+    track_bytes_per_trait.unit = 'bytes'
+
+
+class TimeSchema(object):
+
+    def time_build_schema(self):
+        _build_schema(100, 100)
+
+
+class TimePickle(object):
+
+    # Pickling and unpickling an object with a large array, as done when
+    # sending it to a worker process, with and without shared memory.
+    params = [False, True]
+    param_names = ['shared']
+
+    def setup(self, shared):
+
+        class Field(HasTraits):
+            values = NumericalTrait(ndim=2, domain='positive', shared=shared)
+
+        self.field = Field()
+        self.field.values = np.ones((2000, 2000))
+
+    def time_pickle(self, shared):
+        pickle.loads(pickle.dumps(self.field.values))
+
+    def track_pickled_bytes(self, shared):
+        return len(pickle.dumps(self.field.values))
+
+    track_pickled_bytes.unit = 'bytes'
@@ -0,0 +1,442 @@
+# Benchmarks for the validation of numerical traits. The time_* benchmarks
+# measure the time taken to validate a single value, the peakmem_* benchmarks
+# measure the peak memory used when validating large arrays, and the track_*
+# benchmarks report the validation throughput in elements per second.
+
+import os
+import time
+import timeit
+import asyncio
+import tempfile
+
+import numpy as np
+from traitlets import HasTraits
+
+from numtraits import (NumericalTrait, Range, Monotonic, SumsTo, avalidate, validate_records,
+                       save_snapshot, load_snapshot)
+
+DOMAINS = [None, 'positive', 'strictly-positive', 'negative',
+           'strictly-negative', (-10., 10.)]
+
+DOMAIN_NAMES = ['none', 'positive', 'strictly-positive', 'negative',
+                'strictly-negative', 'range']
+
+SIZES = [1, 100, 10000, 1000000]
+
+
+def _values_in_domain(domain, shape):
+    # Return values that are valid for the given domain, so that the whole
+    # array has to be checked.
+    if domain in ('negative', 'strictly-negative'):
+        return -np.ones(shape)
+    else:
+        return np.ones(shape)
+
+
+class TimeScalar(object):
+
+    params = DOMAIN_NAMES
+    param_names = ['domain']
+
+    def setup(self, domain):
+        self.trait = NumericalTrait(ndim=0, domain=DOMAINS[DOMAIN_NAMES.index(domain)])
+        self.value = float(_values_in_domain(DOMAINS[DOMAIN_NAMES.index(domain)], ()))
+
+    def time_validate(self, domain):
+        self.trait.validate(None, self.value)
+
+
+class TimeScalarTypes(object):
+
+    # Plain numbers are validated without going through Numpy, which can be
+    # compared to the time taken for 0-d arrays, which are not.
+    params = ['int', 'float', 'bool', 'float32', 'float64', 'int16', '0-d array']
+    param_names = ['type']
+
+    def setup(self, type):
+        self.trait = NumericalTrait(domain='positive')
+        if type == '0-d array':
+            self.value = np.array(1.)
+        elif type in ('int', 'float', 'bool'):
+            self.value = {'int': int, 'float': float, 'bool': bool}[type](1)
+        else:
+            self.value = getattr(np, type)(1)
+
+    def time_validate(self, type):
+        self.trait.validate(None, self.value)
+
+
+class TimeArray(object):
+
+    params = (DOMAIN_NAMES, SIZES)
+    param_names = ['domain', 'size']
+
+    def setup(self, domain, size):
+        domain = DOMAINS[DOMAIN_NAMES.index(domain)]
+        self.trait = NumericalTrait(ndim=1, domain=domain)
+        self.value = _values_in_domain(domain, size)
+
+    def time_validate(self, domain, size):
+        self.trait.validate(None, self.value)
+
+
+class TimeArrayND(object):
+
+    params = [(100,), (100, 100), (100, 100, 100)]
+    param_names = ['shape']
+
+    def setup(self, shape):
+        self.trait = NumericalTrait(shape=shape, domain='positive')
+        self.value = np.ones(shape)
+        self.non_contiguous = np.ones(shape[:-1] + (shape[-1] * 2,))[..., ::2]
+
+    def time_validate(self, shape):
+        self.trait.validate(None, self.value)
+
+    def time_validate_non_contiguous(self, shape):
+        self.trait.validate(None, self.non_contiguous)
+
+
+class TimeFinite(object):
+
+    # Rejecting NaN and infinite values reuses the min/max reductions of the
+    # domain check, so should cost little more than the domain alone.
+    params = (['domain', 'finite', 'domain+finite'], SIZES)
+    param_names = ['check', 'size']
+
+    def setup(self, check, size):
+        kwargs = {}
+        if 'domain' in check:
+            kwargs['domain'] = (-10., 10.)
+        if 'finite' in check:
+            kwargs['allow_nan'] = kwargs['allow_inf'] = False
+        self.trait = NumericalTrait(ndim=1, **kwargs)
+        self.value = np.ones(size)
+
+    def time_validate(self, check, size):
+        self.trait.validate(None, self.value)
+
+
+class TimeConstraints(object):
+
+    params = (['range', 'per-axis range', 'monotonic', 'sums-to', 'all'], [100, 1000000])
+    param_names = ['constraint', 'size']
+
+    def setup(self, constraint, size):
+        constraints = {'range': [Range(0., 1.)],
+                       'per-axis range': [Range([0., 0., 0.], [1., 1., 1.])],
+                       'monotonic': [Monotonic(axis=0)],
+                       'sums-to': [SumsTo(1., axis=1)],
+                       'all': [Range([0., 0., 0.], [1., 1., 1.]), SumsTo(1., axis=1)]}[constraint]
+        self.trait = NumericalTrait(ndim=2, constraints=constraints)
+        self.value = np.full((size, 3), 1. / 3.)
+
+    def time_validate(self, constraint, size):
+        self.trait.validate(None, self.value)
+
+
+class TimeCached(object):
+
+    # Re-assigning an array that has already been validated by a trait with
+    # cache=True, compared to the same trait without the cache.
+    params = ([False, True], SIZES)
+    param_names = ['cache', 'size']
+
+    def setup(self, cache, size):
+        self.trait = NumericalTrait(ndim=1, domain='positive', cache=cache)
+        self.value = np.ones(size)
+        self.trait.validate(None, self.value)
+
+    def time_validate(self, cache, size):
+        self.trait.validate(None, self.value)
+
+
+class TimeParallel(object):
+
+    # Arrays above the threshold for parallel checks, which are only faster
+    # than serial checks on machines with several cores.
+    params = ([False, True], [2 ** 22, 2 ** 25])
+    param_names = ['parallel', 'size']
+
+    def setup(self, parallel, size):
+        self.trait = NumericalTrait(ndim=1, domain=(-10., 10.), parallel=parallel)
+        self.value = np.ones(size)
+
+    def time_validate(self, parallel, size):
+        self.trait.validate(None, self.value)
+
+
+class TimeUpdate(object):
+
+    # In-place updates of a stored array with validate_updates=True, which
+    # should depend on the size of the update but not on the size of the
+    # array, compared to assigning the whole array again.
+    params = ([10000, 10000000], [1, 1000])
+    param_names = ['size', 'update']
+
+    def setup(self, size, update):
+
+        class Grid(HasTraits):
+            values = NumericalTrait(ndim=1, domain='positive', validate_updates=True)
+            plain = NumericalTrait(ndim=1, domain='positive')
+
+        self.grid = Grid()
+        self.grid.values = np.ones(size)
+        self.grid.plain = np.ones(size)
+        self.update = np.full(update, 2.)
+
+    def time_setitem(self, size, update):
+        self.grid.values[:len(self.update)] = self.update
+
+    def time_inplace_ufunc(self, size, update):
+        values = self.grid.values[:len(self.update)]
+        values += 1.
+
+    def time_reassign(self, size, update):
+        plain = self.grid.plain
+        plain[:len(self.update)] = self.update
+        self.grid.plain = plain
+
+
+class TimeSequence(object):
+
+    params = ([10, 1000, 100000], ['list', 'tuple'])
+    param_names = ['size', 'type']
+
+    def setup(self, size, type):
+        self.trait = NumericalTrait(ndim=1, domain='positive')
+        self.value = list(np.ones(size))
+        if type == 'tuple':
+            self.value = tuple(self.value)
+
+    def time_validate(self, size, type):
+        self.trait.validate(None, self.value)
+
+
+class TimeGenerator(object):
+
+    # Generators are read block by block into an array, which can be compared
+    # to building a list first, and to a generator with an invalid value near
+    # the start, which should be rejected without reading the rest.
+    params = ([1000, 1000000], [None, 1000])
+    param_names = ['size', 'shape']
+
+    def setup(self, size, shape):
+        if shape is None:
+            self.trait = NumericalTrait(ndim=1, domain='positive')
+        else:
+            self.trait = NumericalTrait(shape=(size,), domain='positive')
+        self.size = size
+
+    def _values(self, invalid=None):
+        for i in range(self.size):
+            yield -1. if i == invalid else 1.
+
+    def time_generator(self, size, shape):
+        self.trait.validate(None, self._values())
+
+    def time_list(self, size, shape):
+        self.trait.validate(None, list(self._values()))
+
+    def time_generator_invalid(self, size, shape):
+        try:
+            self.trait.validate(None, self._values(invalid=10))
+        except Exception:
+            pass
+
+
+class TimeQuantity(object):
+
+    params = (['astropy', 'pint', 'quantities'], [1, 1000, 1000000])
+    param_names = ['framework', 'size']
+
+    def setup(self, framework, size):
+        try:
+            if framework == 'astropy':
+                from astropy import units as u
+                unit, value_unit = u.m, u.km
+            elif framework == 'pint':
+                from pint import UnitRegistry
+                ureg = UnitRegistry()
+                unit, value_unit = ureg.m, ureg.km
+            else:
+                import quantities as pq
+                unit, value_unit = pq.m, pq.km
+        except ImportError:
+            raise NotImplementedError()
+        self.trait = NumericalTrait(convertible_to=unit, domain='positive')
+        self.convert_trait = NumericalTrait(convertible_to=unit, domain='positive', convert=True)
+        if size == 1:
+            self.value = 3. * value_unit
+        else:
+            self.value = np.ones(size) * value_unit
+
+    def time_validate(self, framework, size):
+        self.trait.validate(None, self.value)
+
+    def time_validate_convert(self, framework, size):
+        self.convert_trait.validate(None, self.value)
+
+
+class TimeAssignment(object):
+
+    def setup(self):
+
+        class Sphere(HasTraits):
+            radius = NumericalTrait(ndim=0, domain='strictly-positive')
+            position = NumericalTrait(shape=(3,))
+            mass = NumericalTrait(ndim=0, domain='positive')
+
+        self.sphere = Sphere()
+        self.position = np.array([1., 2., 3.])
+
+    def time_scalar(self):
+        self.sphere.radius = 1.
+
+    def time_array(self):
+        self.sphere.position = self.position
+
+    def time_tuple(self):
+        self.sphere.position = (1., 2., 3.)
+
+    def time_all(self):
+        self.sphere.radius = 1.
+        self.sphere.position = self.position
+        self.sphere.mass = 2.
+
+
+class Record(HasTraits):
+
+    mass = NumericalTrait(ndim=0, domain='positive')
+    position = NumericalTrait(shape=(3,))
+    velocity = NumericalTrait(shape=(3,), domain=(-1000., 1000.))
+
+
+class TimeRecords(object):
+
+    # Validating many records in a pool of processes, which should scale with
+    # the number of cores (the pool start-up time is included).
+    params = [1, 2, 4]
+    param_names = ['processes']
+    timeout = 120
+
+    def setup(self, processes):
+        self.records = [{'mass': 1., 'position': (1., 2., 3.), 'velocity': (4., 5., 6.)}
+                        for i in range(100000)]
+
+    def time_validate_records(self, processes):
+        validate_records(Record, self.records, processes=processes)
+
+
+class TimeSnapshot(object):
+
+    # Restoring a snapshot of a model with large arrays, either checking the
+    # data against the checksums or validating it, compared to assigning the
+    # arrays again (which validates them).
+    params = [(None, True), ('r', True), ('r', False)]
+    param_names = ['mmap_mode, verify']
+
+    def setup(self, options):
+
+        class Model(HasTraits):
+            grid = NumericalTrait(ndim=2, domain=(-10., 10.))
+            times = NumericalTrait(ndim=1, constraints=[Monotonic()])
+
+        self.model_class = Model
+        model = Model()
+        model.grid = np.ones((2000, 2000))
+        model.times = np.arange(1000000.)
+        self.grid = model.grid
+        self.times = model.times
+        fd, self.filename = tempfile.mkstemp(suffix='.snap')
+        os.close(fd)
+        save_snapshot(self.filename, model)
+
+    def teardown(self, options):
+        os.remove(self.filename)
+
+    def time_load(self, options):
+        mmap_mode, verify = options
+        load_snapshot(self.filename, self.model_class(), verify=verify, mmap_mode=mmap_mode)
+
+    def time_assign(self, options):
+        model = self.model_class()
+        model.grid = self.grid
+        model.times = self.times
+
+
+class MemArray(object):
+
+    params = [['float64', 'float32', 'int32'], DOMAIN_NAMES[1:]]
+    param_names = ['dtype', 'domain']
+
+    def setup(self, dtype, domain):
+        domain = DOMAINS[DOMAIN_NAMES.index(domain)]
+        self.trait = NumericalTrait(ndim=1, domain=domain)
+        self.value = _values_in_domain(domain, 10000000).astype(dtype)
+
+    def peakmem_validate(self, dtype, domain):
+        self.trait.validate(None, self.value)
+
+
+class TrackThroughput(object):
+
+    params = [1000, 1000000, 10000000]
+    param_names = ['size']
+
+    def setup(self, size):
+        self.trait = NumericalTrait(ndim=1, domain=(-10., 10.))
+        self.value = np.ones(size)
+
+    def track_throughput(self, size):
+        number = max(1, 10000000 // size)
+        duration = min(timeit.repeat(lambda: self.trait.validate(None, self.value),
+                                     number=number, repeat=3))
+        return size * number / duration
+
+    track_throughput.unit = 'elements/s'
+
+
+class TrackLoopLatency(object):
+
+    # The longest time for which an asyncio event loop is blocked while large
+    # arrays are assigned, either directly or with avalidate.
+    params = ['assign', 'avalidate']
+    param_names = ['method']
+
+    def setup(self, method):
+
+        class Grid(HasTraits):
+            values = NumericalTrait(ndim=1, domain=(-10., 10.))
+
+        self.grid = Grid()
+        self.value = np.ones(2 ** 24)
+
+    def track_max_latency(self, method):
+
+        async def tick(gaps, done):
+            last = time.perf_counter()
+            while not done.is_set():
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        async def assign(gaps):
+            done = asyncio.Event()
+            ticker = asyncio.ensure_future(tick(gaps, done))
+            await asyncio.sleep(0.01)
+            for i in range(5):
+                if method == 'avalidate':
+                    await avalidate(self.grid, 'values', self.value)
+                else:
+                    self.grid.values = self.value
+                    await asyncio.sleep(0)
+            done.set()
+            await ticker
+
+        gaps = []
+        asyncio.run(assign(gaps))
+        return max(gaps) * 1000
+
+    track_max_latency.unit = 'ms'
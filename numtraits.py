@@ -23,9 +23,19 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from __future__ import print_function
+import os
+import sys
+import copy
+import time
+import weakref
+import threading
+from contextlib import contextmanager
+from collections import deque
+from itertools import islice
+from functools import lru_cache, partial
+from operator import attrgetter
 
-from traitlets import TraitType, TraitError
+from traitlets import HasTraits, TraitType, TraitError, Undefined
 
 import numpy as np
 
@@ -35,142 +45,2657 @@ ASTROPY = 'astropy'
 PINT = 'pint'
 QUANTITIES = 'quantities'
 
+class MultipleTraitErrors(TraitError):
+    """
+    Exception raised when several values fail validation at once.
+
+    The individual error messages are available in the ``errors`` attribute,
+    which is a dictionary mapping the index (or name) of each invalid value to
+    its error message.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        lines = ["{0} values failed validation:".format(len(errors))]
+        for key in sorted(errors):
+            lines.append("  [{0}] {1}".format(key, errors[key]))
+        super(MultipleTraitErrors, self).__init__("\n".join(lines))
+
+    def __reduce__(self):
+        # Exceptions are pickled using their arguments by default, which here
+        # would be the message rather than the errors.
+        return (MultipleTraitErrors, (self.errors,))
+
+
+class Constraint(object):
+    """
+    Base class for constraints on the values of numerical traits, which are
+    given to `NumericalTrait` with the ``constraints`` argument.
+
+    Sub-classes should implement ``check``, which is given a Numpy array and
+    returns whether it satisfies the constraint, and ``message``, which
+    returns the error message for a trait with a given name. If the
+    constraint only relates values within the same index along the first
+    axis, ``check`` can also be called with blocks of rows, which should be
+    indicated by ``splittable`` returning `True`. Sub-classes can also
+    implement ``check_trait`` to reject traits whose values the constraint
+    cannot apply to.
+    """
+
+    def check(self, values):
+        raise NotImplementedError()
+
+    def message(self, name):
+        raise NotImplementedError()
+
+    def check_trait(self, ndim, shape):
+        """
+        Check that the constraint can apply to the values of a trait with
+        ``ndim`` dimensions and the given ``shape`` (either of which may be
+        `None` if not known), raising a `TraitError` otherwise.
+        """
+        pass
+
+    def splittable(self, ndim):
+        """
+        Whether the constraint can be checked independently on blocks of rows
+        of an array with ``ndim`` dimensions.
+        """
+        return False
+
+
+class Range(Constraint):
+    """
+    Constrain values to lie within bounds, which can differ along axes.
+
+    The bounds are broadcast against the values, so for example for an array
+    with shape ``(N, 3)``, bounds with shape ``(3,)`` give separate bounds
+    for each column. The values are reduced to their minimum and maximum
+    along the axes over which the bounds are constant before being compared
+    to the bounds. NaN values are ignored.
+
+    Parameters
+    ----------
+    lower, upper : float or array-like, optional
+        The lower and upper bounds, or `None` if unbounded.
+    """
+
+    def __init__(self, lower=None, upper=None):
+        self.lower = None if lower is None else np.asarray(lower, dtype=float)
+        self.upper = None if upper is None else np.asarray(upper, dtype=float)
+
+    def check(self, values):
+        for bound, reduce, valid in ((self.lower, np.fmin.reduce, np.greater_equal),
+                                     (self.upper, np.fmax.reduce, np.less_equal)):
+            if bound is None or values.size == 0:
+                continue
+            extreme = _reduce_leading(reduce, values, bound.ndim)
+            if not np.all(valid(extreme, bound) | np.isnan(extreme)):
+                return False
+        return True
+
+    def message(self, name):
+        return "All values of {0} should be in the range [{1}:{2}]".format(name, _format_bound(self.lower),
+                                                                          _format_bound(self.upper))
+
+    def splittable(self, ndim):
+        return all(bound is None or bound.ndim < ndim for bound in (self.lower, self.upper))
+
+    def check_trait(self, ndim, shape):
+        for bound in (self.lower, self.upper):
+            if bound is None:
+                continue
+            if ndim is not None and bound.ndim > ndim:
+                raise TraitError("Range bounds with shape {0} cannot be used with ndim={1}".format(bound.shape, ndim))
+            if shape is not None:
+                for bound_size, size in zip(bound.shape[::-1], tuple(shape)[::-1]):
+                    if bound_size not in (1, size):
+                        raise TraitError("Range bounds with shape {0} cannot be used with shape={1}".format(bound.shape, shape))
+
+
+class Monotonic(Constraint):
+    """
+    Constrain values to be monotonically increasing or decreasing along an
+    axis.
+
+    Parameters
+    ----------
+    decreasing : bool, optional
+        Whether values should be decreasing rather than increasing.
+    strict : bool, optional
+        Whether consecutive values are allowed to be equal.
+    axis : int, optional
+        The axis along which the values should be monotonic.
+    """
+
+    def __init__(self, decreasing=False, strict=False, axis=-1):
+        self.decreasing = decreasing
+        self.strict = strict
+        self.axis = axis
+        if decreasing:
+            self._compare = np.less if strict else np.less_equal
+        else:
+            self._compare = np.greater if strict else np.greater_equal
+
+    def check(self, values):
+        if values.ndim == 0:
+            return True
+        values = np.moveaxis(values, self.axis, 0)
+        # Compare consecutive values in blocks, overlapping by one value, so
+        # that the temporary arrays stay small.
+        step = max(1, _BLOCK_SIZE // max(1, values[0].size))
+        for start in range(0, values.shape[0] - 1, step):
+            block = values[start:start + step + 1]
+            if not self._compare(block[1:], block[:-1]).all():
+                return False
+        return True
+
+    def message(self, name):
+        return "{0} should be {1}{2} along axis {3}".format(name, "strictly " if self.strict else "",
+                                                          "decreasing" if self.decreasing else "increasing",
+                                                          self.axis)
+
+    def splittable(self, ndim):
+        return ndim > 1 and self.axis % ndim != 0
+
+    def check_trait(self, ndim, shape):
+        _check_constraint_axis(self, ndim)
+
+
+class SumsTo(Constraint):
+    """
+    Constrain values to sum to a given total along an axis.
+
+    Parameters
+    ----------
+    total : float, optional
+        The expected sum of the values.
+    axis : int, optional
+        The axis along which to sum the values.
+    rtol, atol : float, optional
+        The relative and absolute tolerance on the sums (see `numpy.isclose`).
+    """
+
+    def __init__(self, total=1., axis=-1, rtol=1e-7, atol=0.):
+        self.total = total
+        self.axis = axis
+        self.rtol = rtol
+        self.atol = atol
+
+    def check(self, values):
+        if values.ndim == 0:
+            sums = values
+        elif 0 < values.shape[self.axis] <= _SHORT_AXIS:
+            values = np.moveaxis(values, self.axis, 0)
+            sums = values[0].astype(float)
+            for row in values[1:]:
+                sums += row
+        else:
+            sums = np.add.reduce(values, axis=self.axis)
+        return bool(np.all(np.isclose(sums, self.total, rtol=self.rtol, atol=self.atol)))
+
+    def message(self, name):
+        return "{0} should sum to {1:g} along axis {2}".format(name, self.total, self.axis)
+
+    def splittable(self, ndim):
+        return ndim > 1 and self.axis % ndim != 0
+
+    def check_trait(self, ndim, shape):
+        _check_constraint_axis(self, ndim)
+
+
+def _check_constraint_axis(constraint, ndim):
+    if ndim and not -ndim <= constraint.axis < ndim:
+        raise TraitError("{0} with axis={1} cannot be used with ndim={2}".format(type(constraint).__name__,
+                                                                                constraint.axis, ndim))
+
+
+# Numpy reductions along axes with few elements are slow, since they loop over
+# these elements in the innermost loop. Sums along axes up to this length are
+# instead computed by adding the elements one at a time.
+_SHORT_AXIS = 16
+
+
+def _reduce_leading(reduce, values, ndim):
+    """
+    Reduce values over all but the last ``ndim`` axes.
+
+    Reducing over the leading axes is slow if the trailing axes are small,
+    for example for the columns of an ``(N, 3)`` array, so groups of rows are
+    first reduced together as rows of about 1024 elements, which Numpy can do
+    efficiently, before reducing the groups.
+    """
+    n_leading = values.ndim - ndim
+    if n_leading <= 0:
+        return values
+    trailing = values.shape[n_leading:]
+    columns = values.reshape(-1, int(np.prod(trailing, dtype=int)))
+    n_rows, size = columns.shape
+    group = max(1, 1024 // max(1, size))
+    n_grouped = n_rows // group * group
+    if group > 1 and n_grouped > 0:
+        grouped = reduce(columns[:n_grouped].reshape(-1, group * size), axis=0)
+        columns = np.concatenate([grouped.reshape(group, size), columns[n_grouped:]])
+    return reduce(columns, axis=0).reshape(trailing)
+
+
+def _format_bound(bound):
+    if bound is None:
+        return ""
+    elif bound.ndim == 0:
+        return "{0:g}".format(float(bound))
+    else:
+        return str(bound.tolist())
+
+
 class NumericalTrait(TraitType):
     info_text = 'a numerical trait, either a scalar or a vector'
     def __init__(self, ndim=None, shape=None, domain=None,
-                 default=None, convertible_to=None):
+                 default=None, convertible_to=None, conversion='copy-if-needed',
+                 dtype=None, casting='same_kind', cast=False, cache=False,
+                 parallel=False, convert=False, allow_nan=True, allow_inf=True,
+                 constraints=None, validate_updates=False, readonly=False,
+                 shared=False):
         super(NumericalTrait, self).__init__()
 
-        # Just store all the construction arguments.
-        self.ndim = ndim
-        self.shape = shape
-        self.domain = domain
-        # TODO: traitlets supports a `default` argument in __init__(), we should
-        # probably link them together once we start using this.
-        self.default = default
-        self.target_unit = convertible_to
+        # Just store all the construction arguments. These are kept in a spec
+        # object, which is shared between traits with the same arguments, and
+        # are accessible as attributes of the trait (see _TraitSpec).
+        # TODO: traitlets supports a `default` argument in __init__(), we should
+        # probably link them together once we start using this.
+        spec = _TraitSpec(ndim, shape, domain, default, convertible_to, None, conversion,
+                          dtype, casting, cast, cache, parallel, convert, allow_nan,
+                          allow_inf, constraints, validate_updates, readonly, shared)
+
+        # Check the construction arguments.
+        self._spec = self._checked_spec(spec)
+
+    def _check_args(self):
+        # The spec may be shared with other traits, so we check a copy of it.
+        self._spec = self._checked_spec(self._spec.copy())
+
+    def _checked_spec(self, spec):
+        """
+        Check and complete the construction arguments in a spec, and return
+        the compiled spec to use for this trait.
+        """
+        if spec.target_unit is not None:
+            spec.unit_framework = identify_unit_framework(spec.target_unit)
+        if spec.shape is not None:
+            if spec.ndim is None:
+                spec.ndim = len(spec.shape)
+            else:
+                if spec.ndim != len(spec.shape):
+                    raise TraitError("shape={0} and ndim={1} are inconsistent".format(spec.shape, spec.ndim))
+        if spec.conversion not in CONVERSION_POLICIES:
+            raise TraitError("conversion should be one of {0}".format(", ".join(repr(policy) for policy in CONVERSION_POLICIES)))
+        if spec.dtype is not None:
+            try:
+                spec.dtype = np.dtype(spec.dtype)
+            except TypeError:
+                raise TraitError("dtype={0!r} is not a valid Numpy dtype".format(spec.dtype))
+            if spec.dtype.kind not in 'biufc':
+                raise TraitError("dtype={0} is not a numerical dtype".format(spec.dtype))
+            if spec.dtype.kind == 'c' and spec.domain is not None:
+                raise TraitError("domain cannot be used with dtype={0}".format(spec.dtype))
+            if spec.dtype.kind == 'c' and not (spec.allow_nan and spec.allow_inf):
+                raise TraitError("allow_nan and allow_inf cannot be used with dtype={0}".format(spec.dtype))
+        if spec.casting not in CASTING_RULES:
+            raise TraitError("casting should be one of {0}".format(", ".join(repr(rule) for rule in CASTING_RULES)))
+        if spec.cast and spec.dtype is None:
+            raise TraitError("dtype should be specified if cast=True")
+        if spec.convert and spec.target_unit is None:
+            raise TraitError("convertible_to should be specified if convert=True")
+        if spec.constraints is not None:
+            try:
+                spec.constraints = tuple(spec.constraints)
+            except TypeError:
+                raise TraitError("constraints should be a list of Constraint instances")
+            if not all(isinstance(constraint, Constraint) for constraint in spec.constraints):
+                raise TraitError("constraints should be a list of Constraint instances")
+            for constraint in spec.constraints:
+                constraint.check_trait(spec.ndim, spec.shape)
+        if spec.validate_updates and spec.target_unit is not None:
+            raise TraitError("validate_updates cannot be used with convertible_to")
+        if spec.validate_updates and spec.readonly:
+            raise TraitError("validate_updates and readonly cannot be used together")
+        if spec.shared and spec.target_unit is not None:
+            raise TraitError("shared cannot be used with convertible_to")
+        if spec.shared and spec.validate_updates:
+            raise TraitError("validate_updates and shared cannot be used together")
+        return _intern_spec(spec, type(self))
+
+    def validate(self, obj, value):
+
+        # Inside a deferred() context, values are only recorded, and are
+        # validated when the context exits.
+        if _DEFERRED and id(obj) in _DEFERRED:
+            pending = _DEFERRED[id(obj)]
+            if self.name not in pending:
+                pending[self.name] = (self, obj._trait_values.get(self.name, Undefined))
+            return value
+
+        # Values that have already been validated and stored are assigned
+        # again by traitlets when held notifications are released.
+        if _COMMITTED and id(obj) in _COMMITTED:
+            if _COMMITTED[id(obj)].get(self.name, _SAME) is value:
+                return value
+
+        spec = self._spec
+
+        if spec._validate_scalar is not None and type(value) in _SCALAR_TYPES:
+            if _PROFILING:
+                with _profile_stage(self._profile_stats(), 'scalar'):
+                    return spec._validate_scalar(self, value)
+            return spec._validate_scalar(self, value)
+
+        stats = self._profile_stats() if _PROFILING else None
+
+        # Arrays stored by this trait with validate_updates=True stay valid
+        if type(value) is ValidatedArray and value._trait is self and value._spec is spec and value._root is None:
+            return value
+
+        if spec.cache and isinstance(value, np.ndarray):
+            return self._validate_cached(value, stats)
+
+        return self._validate_value(value, stats)
+
+    def _validate_value(self, value, stats=None, checked=False):
+        """
+        Convert and check a value, returning the value to store. If ``stats``
+        is given, the time taken by each stage of the validation is recorded
+        in it (see `enable_profiling`). If ``checked`` is `True`, the value is
+        known to be valid, and is only converted.
+        """
+
+        spec = self._spec
+        value_checks = spec._value_checks
+
+        if spec._stream_shape is not None and _is_stream(value):
+            with _profile_stage(stats, 'stream') as stage:
+                value = num_value = self._read_stream(value)
+                if stage is not None:
+                    stage[2] += num_value.nbytes
+            is_scalar = False
+            checks = spec._stream_checks
+        elif stats is None:
+            value, num_value, is_scalar = self._convert(value)
+            checks = spec._checks
+        else:
+            with _profile_stage(stats, 'convert') as stage:
+                original = value
+                value, num_value, is_scalar = self._convert(value)
+                if not is_scalar and _converted(original, num_value):
+                    stage[2] += num_value.nbytes
+            checks = spec._checks
+
+        if checked:
+            checks = value_checks = ()
+
+        for check in checks:
+            if stats is None:
+                check(self, value, num_value, is_scalar)
+            else:
+                with _profile_stage(stats, check.__name__[len('_check_'):]):
+                    check(self, value, num_value, is_scalar)
+
+        if spec.convert:
+            with _profile_stage(stats, 'convert_units'):
+                value, num_value = self._convert_units(value, num_value)
+
+        if spec.cast:
+            with _profile_stage(stats, 'cast'):
+                value, num_value = self._cast(value, num_value, is_scalar)
+
+        for check in value_checks:
+            if stats is None:
+                check(self, value, num_value, is_scalar)
+            else:
+                with _profile_stage(stats, check.__name__[len('_check_'):]):
+                    check(self, value, num_value, is_scalar)
+
+        if spec._stored:
+            value = _stored_value(self, value)
+
+        return value
+
+    def _validate_cached(self, value, stats=None):
+        """
+        Validate an array, skipping the checks if the same array has already
+        been validated by this trait and has not changed since.
+
+        Only whether the array is valid is cached. If the trait stores a value
+        derived from the array (such as a copy, or the array cast to a
+        different dtype), this is derived again on each assignment, so that
+        objects do not share the stored values.
+        """
+
+        token = _version_token(value)
+
+        if stats is None:
+            result = self._cached_result(value, token)
+        else:
+            with _profile_stage(stats, 'cache'):
+                result = self._cached_result(value, token)
+
+        if result is _SAME:
+            return value
+        elif result is _DERIVED:
+            return self._validate_value(value, stats, checked=True)
+
+        result = self._validate_value(value, stats)
+
+        key = id(value)
+        with _VALIDATED_LOCK:
+            entry = _VALIDATED.get(key)
+            if entry is None or entry[0]() is not value or entry[1] != token:
+                if len(_VALIDATED) >= _VALIDATED_SIZE:
+                    _VALIDATED.pop(next(iter(_VALIDATED)), None)
+                entry = _VALIDATED[key] = (weakref.ref(value, partial(_forget_validated, key)),
+                                           token, {})
+            entry[2][self] = _SAME if result is value else _DERIVED
+
+        return result
+
+    def _cached_result(self, value, token):
+        """
+        Look up an array in the arrays validated by traits with cache=True,
+        returning `_SAME` if it was validated by this trait and stored as-is,
+        `_DERIVED` if a value derived from it was stored, or `None` if it has
+        not been validated by this trait or has changed since (in which case
+        ``token``, the current version token of the array, differs).
+        """
+        with _VALIDATED_LOCK:
+            entry = _VALIDATED.get(id(value))
+            if entry is not None and entry[0]() is value and entry[1] == token:
+                return entry[2].get(self)
+        return None
+
+    def _profile_stats(self):
+        """
+        Return the statistics recorded for this trait while profiling.
+        """
+        if self.this_class is None:
+            label = self.name
+        else:
+            label = "{0}.{1}".format(self.this_class.__name__, self.name)
+        return _PROFILE.setdefault(label, {})
+
+    def validate_many(self, values):
+        """
+        Validate many values at once.
+
+        The values can be given either as a list of values, or as a single
+        array (or quantity) in which the first dimension runs over the
+        values. Where possible, the values are stacked and checked in a single
+        vectorized pass rather than one at a time.
+
+        Parameters
+        ----------
+        values : list or `numpy.ndarray`
+            The values to validate.
+
+        Returns
+        -------
+        values : list or `numpy.ndarray`
+            The validated values - this is a list if a list was given, and the
+            original array otherwise. As for ``validate``, arrays are stored
+            depending on the ``validate_updates``, ``readonly`` and ``shared``
+            options, for instance as read-only views if ``readonly=True``.
+
+        Raises
+        ------
+        MultipleTraitErrors
+            If any of the values are invalid. The ``errors`` attribute of the
+            exception gives the error message for each invalid index.
+        """
+
+        if hasattr(values, 'shape') and hasattr(values, 'ndim'):
+            try:
+                num_values, _ = _numerical_array(values, self._spec._kinds, self._spec._sequence_dtype)
+            except Exception as exc:
+                raise TraitError("Could not convert values of {0} to a Numpy array (Exception: {1})".format(self.name, exc))
+            if num_values.ndim == 0:
+                raise TraitError("Values of {0} should be given as a sequence".format(self.name))
+            spec = self._spec
+            self._raise_errors(self._stacked_errors(values, num_values, spec._checks))
+            if self.convert:
+                values, num_values = self._convert_units(values, num_values)
+            if self.cast:
+                values, num_values = self._cast(values, num_values, False)
+            self._raise_errors(self._stacked_errors(values, num_values, spec._value_checks))
+            if spec._stored:
+                values = _stored_value(self, values)
+            return values
+
+        values = list(values)
+
+        # Values with units are validated one at a time, otherwise we try
+        # and stack the values into a single array.
+        num_values = None
+        if self.target_unit is None and len(values) > 0:
+            try:
+                num_values = np.asarray(values, dtype=self._spec._sequence_dtype)
+            except Exception:
+                pass
+            else:
+                if num_values.dtype.kind not in self._spec._kinds:
+                    num_values = None
+
+        if num_values is None:
+            errors = {}
+            validated = []
+            for index, value in enumerate(values):
+                try:
+                    validated.append(self.validate(None, value))
+                except TraitError as exc:
+                    errors[index] = exc.args[0]
+            self._raise_errors(errors)
+            return validated
+
+        errors = self._stacked_errors(values, num_values, self._spec._checks)
+        if self.cast:
+            with np.errstate(over='ignore', invalid='ignore'):
+                cast_values = np.asarray(num_values, dtype=self.dtype)
+            for index, message in self._stacked_errors(values, cast_values, self._spec._value_checks).items():
+                errors.setdefault(index, message)
+
+        # Return the values as validate would have, i.e. converting any
+        # values that are not scalars or arrays to arrays. Numpy converts
+        # strings to numbers when stacking them, so scalars are checked to be
+        # numbers here, as they would be by validate.
+        validated = []
+        for index, value in enumerate(values):
+            if np.isscalar(value):
+                if type(value) not in _SCALAR_TYPES and not isinstance(value, memoryview):
+                    try:
+                        self._check_number(value)
+                    except TraitError as exc:
+                        errors[index] = exc.args[0]
+                validated.append(value)
+            elif hasattr(value, 'shape') and hasattr(value, 'ndim'):
+                validated.append(value)
+            else:
+                validated.append(num_values[index])
+
+        self._raise_errors(errors)
+
+        if self.cast:
+            validated = [self._cast(*self._convert(value))[0] for value in validated]
+
+        if self._spec._stored:
+            validated = [_stored_value(self, value) for value in validated]
+
+        return validated
+
+    def _stacked_errors(self, values, num_values, checks):
+        """
+        Run the given checks on values stacked along the first dimension, and
+        return a dictionary of error messages for the invalid indices.
+        """
+
+        n_values = num_values.shape[0]
+
+        if n_values == 0:
+            return {}
+
+        # Apart from the domain and constraints, all checks depend only on
+        # the shape, dtype and units of the values, which are the same for
+        # all the stacked values, so we only need to check the first value.
+        # The values in a list can have different dtypes, so these are
+        # checked separately.
+        spec = self._spec
+        names = [check.__name__ for check in checks]
+        is_list = isinstance(values, list)
+        is_scalar = np.isscalar(values[0])
+        for check in checks:
+            if check.__name__ not in ('_check_domain', '_check_finite', '_check_constraints') and not (
+                    is_list and check.__name__ == '_check_dtype'):
+                try:
+                    check(self, values[0], num_values[0], is_scalar)
+                except TraitError as exc:
+                    return dict.fromkeys(range(n_values), exc.args[0])
+
+        errors = {}
+
+        if is_list and '_check_dtype' in names:
+            for index, value in enumerate(values):
+                try:
+                    self._check_list_dtype(value, num_values[index])
+                except TraitError as exc:
+                    errors[index] = exc.args[0]
+
+        bounds = []
+        if '_check_finite' in names:
+            bounds.append((None, None, False, False, spec.allow_nan, spec.allow_inf))
+        if '_check_domain' in names:
+            bounds.append(spec._bounds)
+
+        if bounds and num_values.size > 0:
+            rows = num_values.reshape(n_values, -1)
+            for row_bounds in bounds:
+                valid = _rows_within_bounds(rows, *row_bounds)
+                for index in np.nonzero(~valid)[0]:
+                    if int(index) not in errors:
+                        violation = _bounds_violation(rows[index], *row_bounds)
+                        errors[int(index)] = self._domain_message(is_scalar, violation)
+
+        if '_check_constraints' in names:
+            for index in range(n_values):
+                if index not in errors:
+                    try:
+                        self._check_constraints(values[index], num_values[index], is_scalar)
+                    except TraitError as exc:
+                        errors[index] = exc.args[0]
+
+        return errors
+
+    def _check_list_dtype(self, value, num_value):
+        """
+        Check the dtype of a value from a list given to ``validate_many``, for
+        which ``num_value`` is the corresponding row of the stacked values.
+        """
+        is_scalar = np.isscalar(value)
+        if is_scalar or hasattr(value, 'dtype'):
+            self._check_dtype(value, value, is_scalar)
+            return
+        # Sequences are stacked with the dtype needed for all the values, so
+        # if this is rejected we check the dtype of the sequence by itself.
+        try:
+            self._check_dtype(value, num_value, False)
+        except TraitError:
+            self._check_dtype(value, np.asarray(value), False)
+
+    def _check_number(self, value):
+        if not np.isreal(value) and not (self._spec._complex and np.iscomplexobj(value)):
+            raise TraitError("{0} should be a numerical value".format(self.name))
+
+    def _raise_errors(self, errors):
+        if errors:
+            raise MultipleTraitErrors(errors)
+
+    def _convert(self, value):
+        """
+        Find the numerical values for a value, returning the value to store,
+        the numerical values, and whether the value is a scalar.
+        """
+
+        # We proceed by checking whether Numpy tells us the value is a
+        # scalar. If Numpy isscalar returns False, it could still be scalar
+        # but be a Quantity with units, so we then extract the numerical
+        # values. Note that Numpy considers memoryview objects to be scalars.
+        spec = self._spec
+
+        if np.isscalar(value) and not isinstance(value, memoryview):
+            self._check_number(value)
+            is_scalar = True
+            num_value = value
+        else:
+
+            # The following works for Astropy and Pint quantities
+            try:
+                num_value, copied = _numerical_array(value, spec._kinds, spec._sequence_dtype)
+            except Exception as exc:
+                raise TraitError("Could not convert value of {0} to a Numpy array (Exception: {1})".format(self.name, exc))
+
+            if copied and num_value.ndim > 0 and spec.conversion == 'never-copy':
+                raise TraitError("{0} could not be converted to a Numpy array without copying".format(self.name))
+
+            is_scalar = False
+
+            # If value is not scalar, then Astropy quantities will have a shape
+            # and ndim, so we can then safely set value to the unitless Numpy
+            # array if either shape or ndim are not present (Pint and
+            # quantities Quantity objects are recognized by their magnitude and
+            # units). This will cause e.g. tuples and lists to get converted.
+            # Objects that support the buffer protocol, such as memoryviews,
+            # are also replaced by the Numpy array, which is a view of the
+            # same memory.
+            if _has_magnitude(value):
+                pass
+            elif (not hasattr(value, 'shape') or not hasattr(value, 'ndim') or
+                    isinstance(value, memoryview)):
+                value = num_value
+
+            if not copied and spec.conversion == 'always-copy':
+                if value is num_value:
+                    value = num_value = np.array(num_value)
+                else:
+                    value = copy.copy(value)
+                    num_value, _ = _numerical_array(value, spec._kinds)
+
+        return value, num_value, is_scalar
+
+    def _read_stream(self, values):
+        """
+        Read the values from an iterator (such as a generator) into a Numpy
+        array of floats, without building an intermediate list.
+
+        The values are read in blocks, and the domain of each block is
+        checked as soon as it has been read, so that invalid values are
+        found without reading the rest of the iterator. If the length of the
+        trait is known, the array is allocated in advance. For traits with
+        more than one dimension, the iterator should give the rows of the
+        array. For traits with a dtype, the values are instead read into a
+        list and converted as a list would be, so that the casting rules
+        apply to the dtype of the values themselves, and the domain is
+        checked once all the values have been read.
+        """
+
+        spec = self._spec
+
+        if spec.conversion == 'never-copy':
+            raise TraitError("{0} could not be converted to a Numpy array without copying".format(self.name))
+
+        if spec.dtype is not None:
+            try:
+                array, _ = _numerical_array(list(values), spec._kinds, spec._sequence_dtype)
+            except Exception as exc:
+                raise TraitError("Could not convert value of {0} to a Numpy array (Exception: {1})".format(self.name, exc))
+            return array
+
+        length = spec._stream_shape[0]
+        row_shape = spec._stream_shape[1:]
+        dtype = np.dtype((float, row_shape)) if row_shape else np.dtype(float)
+        block_size = max(1, _BLOCK_SIZE // max(1, int(np.prod(row_shape, dtype=int))))
+
+        if length is None:
+            blocks = []
+        else:
+            array = np.empty(spec._stream_shape)
+
+        iterator = iter(values)
+        n_read = 0
+
+        while length is None or n_read < length:
+            n_block = block_size if length is None else min(block_size, length - n_read)
+            try:
+                block = np.fromiter(islice(iterator, n_block), dtype=dtype)
+            except Exception as exc:
+                raise TraitError("Could not convert value of {0} to a Numpy array (Exception: {1})".format(self.name, exc))
+            if spec._bounds is not None and block.size > 0:
+                violation = _bounds_violation(block, *spec._bounds)
+                if violation is not None:
+                    raise TraitError(self._domain_message(False, violation))
+            if length is None:
+                blocks.append(block)
+            else:
+                array[n_read:n_read + len(block)] = block
+            n_read += len(block)
+            if len(block) < n_block:
+                break
+
+        if length is None:
+            return np.concatenate(blocks)
+
+        if n_read < length:
+            found = "{0}".format(n_read)
+        elif next(iterator, _SAME) is not _SAME:
+            found = "more"
+        else:
+            return array
+
+        if len(spec._stream_shape) == 1:
+            raise TraitError("{0} has incorrect length (expected {1} but found {2})".format(self.name, length, found))
+        else:
+            raise TraitError("{0} has incorrect shape (expected {1} but found {2} rows)".format(self.name, spec.shape, found))
+
+    def _validate_update(self, values):
+        """
+        Check values that are about to be written into part of an array
+        stored by the trait (see `ValidatedArray`), returning their numerical
+        values. Only the dtype and domain of the values are checked, since the
+        shape of the array cannot change.
+        """
+        spec = self._spec
+        try:
+            num_values, _ = _numerical_array(values, spec._kinds, spec._sequence_dtype)
+        except Exception as exc:
+            raise TraitError("Could not convert value of {0} to a Numpy array (Exception: {1})".format(self.name, exc))
+        if spec.dtype is not None:
+            if np.isscalar(values):
+                self._check_dtype(values, values, True)
+            elif hasattr(values, 'dtype') or num_values.size == 0 or num_values.dtype.kind not in 'biuf':
+                self._check_dtype(values, num_values, False)
+            else:
+                # Sequences of Python numbers do not have a dtype, so as for
+                # scalars, we check the smallest dtype that can hold the
+                # values, which is given by the extreme values.
+                self._check_dtype(values, num_values.min().item(), True)
+                self._check_dtype(values, num_values.max().item(), True)
+        if spec.cast:
+            # The values are cast to the dtype of the array when written, so
+            # the domain is checked on the cast values.
+            if type(self)._check_finite in spec._checks:
+                self._check_finite(values, num_values, False)
+            with np.errstate(over='ignore', invalid='ignore'):
+                num_values = np.asarray(num_values, dtype=spec.dtype)
+        if spec._bounds is not None:
+            self._check_domain(values, num_values, False)
+        return num_values
+
+    def _check_scalar(self, value, num_value, is_scalar):
+        if not is_scalar:
+            raise TraitError("{0} should be a scalar value".format(self.name))
+
+    def _check_ndim(self, value, num_value, is_scalar):
+        if is_scalar or num_value.ndim != self.ndim:
+            if self.ndim == 1:
+                raise TraitError("{0} should be a 1-d sequence".format(self.name))
+            else:
+                raise TraitError("{0} should be a {1:d}-d array".format(self.name, self.ndim))
+
+    def _check_shape(self, value, num_value, is_scalar):
+        if num_value.shape != self._spec._shape:
+            if self.ndim == 1:
+                raise TraitError("{0} has incorrect length (expected {1} but found {2})".format(self.name, self.shape[0], num_value.shape[0]))
+            else:
+                raise TraitError("{0} has incorrect shape (expected {1} but found {2})".format(self.name, self.shape, num_value.shape))
+
+    def _check_dtype(self, value, num_value, is_scalar):
+        if is_scalar and not isinstance(num_value, np.generic):
+            # Python scalars do not have a fixed dtype, so we use the smallest
+            # dtype that can hold the value.
+            dtype = np.min_scalar_type(num_value)
+            found = type(num_value).__name__
+        else:
+            dtype = found = num_value.dtype
+        spec = self._spec
+        if not np.can_cast(dtype, spec.dtype, casting=spec.casting):
+            raise TraitError("{0} should have a dtype that can be cast to {1} with {2!r} casting (found {3})".format(self.name, self.dtype, self.casting, found))
+
+    def _cast(self, value, num_value, is_scalar):
+        """
+        Cast a value to the dtype of the trait, returning the cast value and
+        its numerical values. Values that do not fit in the dtype are cast as
+        Numpy would cast them (for instance overflowing to infinity), so the
+        domain should be checked on the cast values.
+        """
+        dtype = self.dtype
+        with np.errstate(over='ignore', invalid='ignore'):
+            if is_scalar:
+                try:
+                    value = np.asarray(value).astype(dtype)[()]
+                except OverflowError:
+                    raise TraitError("{0} could not be cast to {1}".format(self.name, dtype))
+                return value, value
+            if num_value.dtype == dtype:
+                return value, num_value
+            if self.conversion == 'never-copy':
+                raise TraitError("{0} could not be converted to {1} without copying".format(self.name, dtype))
+            if value is num_value:
+                value = num_value = np.asarray(num_value, dtype=dtype)
+            elif isinstance(value, np.ndarray):  # astropy and quantities
+                value = value.astype(dtype)
+                num_value = value.view(np.ndarray)
+            else:  # pint
+                num_value = num_value.astype(dtype)
+                value = type(value)(num_value, value.units)
+        return value, num_value
+
+    def _check_units(self, value, num_value, is_scalar):
+        spec = self._spec
+        assert_unit_convertability(self.name, value, spec.target_unit, spec.unit_framework)
+
+    def _convert_units(self, value, num_value):
+        """
+        Convert a validated value to the target unit of the trait, returning
+        the converted value and its numerical values.
+        """
+        scale, offset = _conversion_factors(self.unit_framework, self.target_unit,
+                                            _value_unit(self.unit_framework, value))
+        if scale == 1 and offset == 0:
+            return value, num_value
+        num_value = num_value * scale
+        if offset != 0:
+            num_value += offset
+        return _with_units(self.unit_framework, value, num_value, self.target_unit), num_value
+
+    def _check_domain(self, value, num_value, is_scalar):
+        spec = self._spec
+        if spec.parallel:
+            violation = _bounds_violation_parallel(num_value, *spec._bounds)
+        else:
+            violation = _bounds_violation(num_value, *spec._bounds)
+        if violation is not None:
+            raise TraitError(self._domain_message(is_scalar, violation))
+
+    def _check_finite(self, value, num_value, is_scalar):
+        spec = self._spec
+        violation = _bounds_violation(num_value, allow_nan=spec.allow_nan, allow_inf=spec.allow_inf)
+        if violation is not None:
+            raise TraitError(self._domain_message(is_scalar, violation))
+
+    def _check_constraints(self, value, num_value, is_scalar):
+        # Constraints may not apply to values whose dimensions are not fixed
+        # by the trait, for instance if an axis is out of bounds.
+        try:
+            constraint = _violated_constraint(num_value, self.constraints)
+        except Exception as exc:
+            raise TraitError("Could not check the constraints of {0} (Exception: {1})".format(self.name, exc))
+        if constraint is not None:
+            raise TraitError(constraint.message(self.name))
+
+    def _domain_message(self, is_scalar, violation='range'):
+        if is_scalar:
+            prefix = ""
+        else:
+            prefix = "All values of "
+        if violation == 'range':
+            text = self._spec._domain_text
+        else:
+            text = _VIOLATION_TEXT[violation]
+        return prefix + "{0} {1}".format(self.name, text)
+
+
+# The construction arguments of numerical traits, which are stored in specs and
+# are available as attributes of the traits.
+_SPEC_ARGUMENTS = ('ndim', 'shape', 'domain', 'default', 'target_unit', 'unit_framework',
+                   'conversion', 'dtype', 'casting', 'cast', 'cache', 'parallel',
+                   'convert', 'allow_nan', 'allow_inf', 'constraints', 'validate_updates',
+                   'readonly', 'shared')
+
+
+class _TraitSpec(object):
+    """
+    The construction arguments of a numerical trait, and the checks built
+    from them.
+
+    Specs use ``__slots__`` to keep them compact, and traits with the same
+    construction arguments share the same spec (see `_intern_spec`), so a
+    spec should not be modified once it has been compiled.
+    """
+
+    __slots__ = _SPEC_ARGUMENTS + ('_checks', '_value_checks', '_bounds', '_domain_text', '_complex',
+                                   '_kinds', '_sequence_dtype', '_shape',
+                                   '_validate_scalar', '_stream_shape', '_stream_checks',
+                                   '_stored', '__weakref__')
+
+    def __init__(self, ndim, shape, domain, default, target_unit, unit_framework,
+                 conversion, dtype, casting, cast, cache, parallel, convert,
+                 allow_nan, allow_inf, constraints, validate_updates, readonly, shared):
+        self.ndim = ndim
+        self.shape = shape
+        self.domain = domain
+        self.default = default
+        self.target_unit = target_unit
+        self.unit_framework = unit_framework
+        self.conversion = conversion
+        self.dtype = dtype
+        self.casting = casting
+        self.cast = cast
+        self.cache = cache
+        self.parallel = parallel
+        self.convert = convert
+        self.allow_nan = allow_nan
+        self.allow_inf = allow_inf
+        self.constraints = constraints
+        self.validate_updates = validate_updates
+        self.readonly = readonly
+        self.shared = shared
+
+    def copy(self):
+        return _TraitSpec(*_get_arguments(self))
+
+    def compile(self, cls):
+        """
+        Build the chain of checks needed for traits of class ``cls``.
+
+        This is done once so that ``validate`` only runs the checks that are
+        relevant to the trait rather than working out on every assignment
+        which of the construction arguments were set. If any of the
+        construction arguments of a trait are changed after initialization,
+        the trait is given a new spec, which is compiled again.
+        """
+
+        checks = []
+        self._bounds = None
+
+        # If a dtype is given, complex values are kept as-is so that the
+        # casting rules can be applied, otherwise they are converted to floats.
+        self._complex = self.dtype is not None and self.dtype.kind == 'c'
+        self._kinds = 'biuf' if self.dtype is None else 'biufc'
+
+        # Sequences are converted to arrays of floats unless a dtype is given,
+        # in which case they are converted to the natural dtype of the values
+        # so that the casting rules can be applied.
+        self._sequence_dtype = float if self.dtype is None else None
+
+        if self.ndim == 0:
+            checks.append(cls._check_scalar)
+        elif self.ndim is not None:
+            checks.append(cls._check_ndim)
+
+        if self.shape is not None:
+            self._shape = tuple(self.shape)
+            checks.append(cls._check_shape)
+
+        if self.dtype is not None:
+            checks.append(cls._check_dtype)
+
+        if self.target_unit is not None:
+            checks.append(cls._check_units)
+
+        bounds = None
+        if isinstance(self.domain, str) and self.domain in _DOMAIN_BOUNDS:
+            bounds, self._domain_text = _DOMAIN_BOUNDS[self.domain]
+        elif type(self.domain) in [tuple, list] and len(self.domain) == 2:
+            lower, upper = self.domain[0], self.domain[-1]
+            bounds = (lower, upper, False, False)
+            self._domain_text = "should be in the range [{0:g}:{1:g}]".format(lower, upper)
+
+        # NaN and infinite values are checked in the same pass as the domain
+        if bounds is not None or not self.allow_nan or not self.allow_inf:
+            self._bounds = (bounds or (None, None, False, False)) + (self.allow_nan, self.allow_inf)
+            checks.append(cls._check_domain)
+
+        if self.constraints:
+            checks.append(cls._check_constraints)
+
+        # The domain and constraints apply to the values that are stored, so
+        # if these are converted to the target unit or cast, they are checked
+        # after the conversion. Casting can also change the values, for
+        # instance floats cast to a smaller dtype can underflow to zero or
+        # overflow to infinity. Integer dtypes cannot hold NaN or infinite
+        # values, so these are looked for before casting.
+        value_checks = []
+        if self.convert or self.cast:
+            value_checks = [check for check in checks
+                            if check is cls._check_domain or check is cls._check_constraints]
+            checks = [check for check in checks if check not in value_checks]
+            if self.cast and self.dtype.kind in 'biu' and not (self.allow_nan and self.allow_inf):
+                checks.append(cls._check_finite)
+
+        self._checks = tuple(checks)
+        self._value_checks = tuple(value_checks)
+
+        # Iterators can be read into an array block by block if the number of
+        # dimensions is known, in which case the domain is checked on each
+        # block as it is read (see NumericalTrait._read_stream), unless the
+        # trait has a dtype. The first dimension can be unknown if the trait
+        # is 1-d.
+        if self.target_unit is not None or self.ndim is None or self.ndim == 0:
+            self._stream_shape = None
+        elif self.shape is not None:
+            self._stream_shape = self._shape
+        elif self.ndim == 1:
+            self._stream_shape = (None,)
+        else:
+            self._stream_shape = None
+        self._stream_checks = tuple(check for check in checks
+                                    if check is not cls._check_domain or self.dtype is not None)
+
+        # Whether validated values are stored differently from how they were
+        # given (see _stored_value).
+        self._stored = self.validate_updates or self.readonly or self.shared
+
+        # Plain numbers can be validated with Python comparisons, without
+        # going through Numpy, unless the trait has units (which plain
+        # numbers do not have), a dtype, or requires an array.
+        if (self.target_unit is None and self.dtype is None and not self.constraints and
+                (self.ndim is None or self.ndim == 0)):
+            self._validate_scalar = _scalar_validator(self)
+        else:
+            self._validate_scalar = None
+
+
+_get_arguments = attrgetter(*_SPEC_ARGUMENTS)
+
+# Compiled specs, given by the class of the traits and their construction
+# arguments. Specs are removed once no traits use them.
+_SPECS = weakref.WeakValueDictionary()
+
+
+def _intern_spec(spec, cls):
+    """
+    Compile a spec for traits of class ``cls``, returning an existing spec
+    with the same construction arguments instead if there is one.
+    """
+    arguments = _get_arguments(spec)
+    # The types of the arguments are included in the key since e.g. 1 == 1.0
+    # but the trait attributes should return the values that were given.
+    key = (cls,) + tuple(map(type, arguments)) + arguments
+    if type(spec.shape) is list or type(spec.domain) is list:
+        key = tuple(tuple(value) if type(value) is list else value for value in key)
+    try:
+        existing = _SPECS.get(key)
+    except (TypeError, ValueError):  # unhashable arguments, or pint units from different registries
+        spec.compile(cls)
+        return spec
+    if existing is not None:
+        return existing
+    spec.compile(cls)
+    _SPECS[key] = spec
+    return spec
+
+
+def _spec_property(name):
+
+    def fget(self):
+        return getattr(self._spec, name)
+
+    def fset(self, value):
+        # Other traits may share the spec, so we replace it by a copy, which
+        # is checked and compiled straight away.
+        spec = self._spec.copy()
+        setattr(spec, name, value)
+        self._spec = self._checked_spec(spec)
+
+    return property(fget, fset)
+
+
+for _name in _SPEC_ARGUMENTS:
+    setattr(NumericalTrait, _name, _spec_property(_name))
+del _name
+
+
+# Types of plain real numbers, which are always scalars, and can be validated
+# with Python comparisons. For each type, this gives the function to use to
+# convert values to Python numbers, since comparing Numpy scalars to Python
+# numbers is slow, or `None` if the values are already Python numbers. Only
+# types that can be converted to Python numbers exactly are included, so
+# long doubles are validated with Numpy comparisons instead.
+_SCALAR_TYPES = {bool: None, int: None, float: None, np.float64: None, np.bool_: bool}
+_SCALAR_TYPES.update((np.dtype(code).type, int) for code in np.typecodes['AllInteger'])
+_SCALAR_TYPES.update((np.dtype(code).type, float) for code in 'ef')
+_SCALAR_TYPES.pop(np.longdouble, None)
+
+
+_INF = float('inf')
+
+
+def _scalar_validator(spec):
+    """
+    Return a function that validates plain numbers for a trait with the given
+    spec using Python comparisons for the domain. The function is called with
+    the trait (used for error messages) and the value.
+    """
+
+    if spec._bounds is None:
+        return lambda trait, value: value
+
+    lower, upper, lower_strict, upper_strict, allow_nan, allow_inf = spec._bounds
+
+    if not (allow_nan and allow_inf):
+
+        def validate_scalar(trait, value):
+            to_python = _SCALAR_TYPES[type(value)]
+            number = value if to_python is None else to_python(value)
+            if number != number:
+                if not allow_nan:
+                    raise TraitError(trait._domain_message(True, 'nan'))
+            elif not allow_inf and (number == _INF or number == -_INF):
+                raise TraitError(trait._domain_message(True, 'inf'))
+            elif ((lower is not None and (number < lower or (lower_strict and number == lower))) or
+                    (upper is not None and (number > upper or (upper_strict and number == upper)))):
+                raise TraitError(trait._domain_message(True))
+            return value
+
+        return validate_scalar
+
+    def validate_scalar(trait, value):
+        to_python = _SCALAR_TYPES[type(value)]
+        number = value if to_python is None else to_python(value)
+        if ((lower is not None and (number < lower or (lower_strict and number == lower))) or
+                (upper is not None and (number > upper or (upper_strict and number == upper)))):
+            raise TraitError(trait._domain_message(True))
+        return value
+
+    return validate_scalar
+
+
+# Whether profiling is enabled, and the statistics recorded while it was. For
+# each trait (given as Class.name), the statistics give for each stage of the
+# validation a list containing the number of calls, the time taken, and the
+# number of bytes of numerical data converted.
+_PROFILING = False
+_PROFILE = {}
+
+
+def enable_profiling():
+    """
+    Start recording statistics about the validation of numerical traits.
+
+    For each trait and each stage of the validation (such as the conversion
+    of values to arrays, the checks of the shape, units and domain, or the
+    lookup of arrays already validated by traits with ``cache=True``), the
+    number of calls, the cumulative time taken, and the number of bytes of
+    numerical data converted are recorded. These can be accessed with
+    `get_profile` or `profile_table`. Profiling is disabled by default, in
+    which case it has almost no overhead.
+    """
+    global _PROFILING
+    _PROFILING = True
+
+
+def disable_profiling():
+    """
+    Stop recording statistics about the validation of numerical traits.
+
+    The statistics recorded so far are kept until `reset_profiling` is called.
+    """
+    global _PROFILING
+    _PROFILING = False
+
+
+def reset_profiling():
+    """
+    Discard the statistics recorded so far.
+    """
+    _PROFILE.clear()
+
+
+def get_profile():
+    """
+    Return the statistics recorded while profiling was enabled.
+
+    Returns
+    -------
+    profile : dict
+        A dictionary giving, for each trait (as ``Class.name``) and then each
+        stage of the validation, a dictionary with the number of ``calls``,
+        the cumulative ``time`` in seconds, and the number of ``bytes``
+        converted.
+    """
+    return dict((label, dict((stage, {'calls': calls, 'time': duration, 'bytes': nbytes})
+                             for stage, (calls, duration, nbytes) in stats.items()))
+                for label, stats in _PROFILE.items())
+
+
+def profile_table():
+    """
+    Return the statistics recorded while profiling was enabled as a table,
+    sorted by decreasing time.
+    """
+
+    rows = []
+    for label, stats in get_profile().items():
+        for stage, stage_stats in stats.items():
+            rows.append((label, stage, stage_stats['calls'], stage_stats['time'], stage_stats['bytes']))
+    rows.sort(key=lambda row: row[3], reverse=True)
+
+    width = max([len('trait')] + [len(row[0]) for row in rows])
+    lines = ["{0:{1}s}  {2:10s}  {3:>10s}  {4:>12s}  {5:>14s}".format('trait', width, 'stage', 'calls', 'time (s)', 'bytes')]
+    for label, stage, calls, duration, nbytes in rows:
+        lines.append("{0:{1}s}  {2:10s}  {3:10d}  {4:12.6f}  {5:14d}".format(label, width, stage, calls, duration, nbytes))
+
+    return "\n".join(lines)
+
+
+def _profile_stage(stats, stage):
+    """
+    Return a context manager recording the time taken by a stage of the
+    validation in the statistics of a trait, which gives the statistics of
+    the stage. If ``stats`` is `None`, nothing is recorded.
+    """
+    if stats is None:
+        return _NOT_PROFILED
+    stage_stats = stats.get(stage)
+    if stage_stats is None:
+        stage_stats = stats[stage] = [0, 0., 0]
+    return _ProfiledStage(stage_stats)
+
+
+def _converted(value, num_value):
+    """
+    Whether the numerical values of a value are a converted copy of the
+    value rather than a view of it.
+    """
+    if not isinstance(num_value, np.ndarray):  # out-of-core arrays
+        return False
+    if _has_magnitude(value):
+        value = value.magnitude
+    if isinstance(value, np.ndarray) or _supports_buffer(value):
+        return not np.may_share_memory(value, num_value)
+    return True
+
+
+class _ProfiledStage(object):
+
+    __slots__ = ('stats', 'start')
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.stats
+
+    def __exit__(self, *exc_info):
+        self.stats[0] += 1
+        self.stats[1] += time.perf_counter() - self.start
+
+
+class _NotProfiled(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return None
+
+
+_NOT_PROFILED = _NotProfiled()
+
+
+# Arrays that have been validated by traits with cache=True, given by the id
+# of the array, and containing a weak reference to the array, the version
+# token of the array when it was validated, and for each trait that validated
+# it, whether the array itself (_SAME) or a value derived from it (_DERIVED)
+# was stored. Arrays are removed once they no longer exist, and the oldest
+# arrays are removed once there are more than _VALIDATED_SIZE arrays. Traits
+# can be validated from several threads (see avalidate), so the arrays are
+# only accessed while holding _VALIDATED_LOCK.
+_VALIDATED = {}
+_VALIDATED_SIZE = 1024
+_VALIDATED_LOCK = threading.RLock()
+_SAME = object()
+_DERIVED = object()
+
+
+def _version_token(array):
+    """
+    Return a token that changes if the memory, layout, writeability, or units
+    of an array change. Changes to the values themselves are not detected.
+    """
+    return (array.__array_interface__['data'][0], array.shape, array.strides,
+            array.dtype, array.flags.writeable,
+            getattr(array, 'unit', None), getattr(array, 'dimensionality', None))
+
+
+def _forget_validated(key, ref=None):
+    # The lock is re-entrant since arrays can be garbage collected (calling
+    # this function) while it is held.
+    with _VALIDATED_LOCK:
+        entry = _VALIDATED.get(key)
+        if entry is not None and (ref is None or entry[0] is ref):
+            del _VALIDATED[key]
+
+
+def mark_dirty(value):
+    """
+    Indicate that the values of an array have changed.
+
+    Traits with ``cache=True`` skip the validation of arrays that they have
+    already validated, unless the memory, shape, strides, dtype, writeability
+    or units of the array have changed. This function should be called after
+    modifying the values of such an array in-place, so that it is fully
+    validated again the next time it is assigned to a trait.
+    """
+    _forget_validated(id(value))
+
+
+class ValidatedArray(np.ndarray):
+    """
+    A Numpy array stored by a numerical trait with ``validate_updates=True``,
+    which checks values written into it in-place.
+
+    Item assignments (``array[100:200] = values``), ``fill``, in-place
+    operators (``array += 1``), and ufuncs with ``out=array`` check only the
+    values being written against the dtype and domain of the trait, so that
+    the cost of the check scales with the size of the update rather than the
+    size of the array. If the trait has constraints, these are checked on the
+    whole array after the update. Invalid updates raise a `TraitError` and
+    leave the array unchanged. Views of the array (such as slices) check
+    writes in the same way, but copies and the results of operations on the
+    array do not.
+
+    Writes that bypass the array, for instance through
+    ``array.view(np.ndarray)`` or another array sharing the same memory, are
+    not checked.
+    """
+
+    # The trait that stored the array, the spec of the trait at the time, and
+    # for views, the array stored by the trait. These are None for arrays
+    # that are not stored by a trait.
+    _trait = None
+    _spec = None
+    _root = None
+
+    def __array_finalize__(self, obj):
+        trait = getattr(obj, '_trait', None)
+        if trait is not None and self.base is not None:
+            self._trait = trait
+            self._spec = obj._spec
+            self._root = obj if obj._root is None else obj._root
+
+    def __setitem__(self, index, values):
+        trait = self._trait
+        if trait is None:
+            return np.ndarray.__setitem__(self, index, values)
+        num_values = trait._validate_update(values)
+        if trait._spec.constraints:
+            old_values = np.array(np.ndarray.__getitem__(self, index))
+            np.ndarray.__setitem__(self, index, num_values)
+            self._check_root(index, old_values)
+        else:
+            np.ndarray.__setitem__(self, index, num_values)
+
+    def fill(self, value):
+        self[...] = value
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+
+        # The arrays written to in-place, which are the outputs and, for
+        # ufunc.at, the first input.
+        out = kwargs.get('out', ())
+        targets = [array for array in out if getattr(array, '_trait', None) is not None]
+        if method == 'at' and getattr(inputs[0], '_trait', None) is not None:
+            targets.append(inputs[0])
+
+        # The ufunc is applied to copies of the arrays written to, and the
+        # results are only copied back once they are valid.
+        copies = dict((id(target), np.array(target)) for target in targets)
+        inputs = tuple(copies.get(id(array)) if id(array) in copies else _plain_array(array)
+                       for array in inputs)
+        if out:
+            kwargs['out'] = tuple(copies.get(id(array)) if id(array) in copies else _plain_array(array)
+                                  for array in out)
+
+        if not targets:
+            return getattr(ufunc, method)(*inputs, **kwargs)
+
+        getattr(ufunc, method)(*inputs, **kwargs)
+
+        for target in targets:
+            target[...] = copies[id(target)]
+
+        if method == 'at':
+            return None
+        return out[0] if len(out) == 1 else out
+
+    def _check_root(self, index, old_values):
+        # Check the constraints of the trait on the whole array, restoring
+        # the old values if they are no longer satisfied.
+        root = self if self._root is None else self._root
+        try:
+            self._trait._check_constraints(root, _plain_array(root), False)
+        except TraitError:
+            np.ndarray.__setitem__(self, index, old_values)
+            raise
+
+
+def _plain_array(array):
+    if isinstance(array, (ValidatedArray, SharedArray)):
+        return array.view(np.ndarray)
+    return array
+
+
+def _validated_view(trait, value):
+    """
+    Return a `ValidatedArray` view of a Numpy array validated by a trait, or
+    the value itself if it is not a plain Numpy array.
+    """
+    if type(value) is ValidatedArray:
+        if value._trait is trait and value._spec is trait._spec and value._root is None:
+            return value
+    elif type(value) is not np.ndarray:
+        return value
+    view = value.view(ValidatedArray)
+    view._trait = trait
+    view._spec = trait._spec
+    view._root = None
+    return view
+
+
+def _stored_value(trait, value):
+    """
+    Return the value to store for a value validated by a trait, depending on
+    the storage options of the trait.
+    """
+    spec = trait._spec
+    if spec.shared:
+        value = _shared_copy(trait, value)
+    if spec.validate_updates:
+        return _validated_view(trait, value)
+    elif spec.readonly:
+        return _readonly_view(value)
+    return value
+
+
+def _readonly_view(value):
+    """
+    Return a read-only view of a validated array or quantity, or the value
+    itself if it is already read-only or is not stored in memory.
+    """
+    if isinstance(value, np.ndarray):  # including astropy and quantities
+        if not value.flags.writeable:
+            return value
+        view = value.view()
+        view.flags.writeable = False
+        return view
+    elif _has_magnitude(value) and isinstance(value.magnitude, np.ndarray):  # pint
+        if not value.magnitude.flags.writeable:
+            return value
+        return type(value)(_readonly_view(value.magnitude), value.units)
+    else:
+        return value
+
+
+# Arrays smaller than this (in bytes) are not worth placing in shared memory,
+# since each shared memory block takes up at least a page and a file
+# descriptor, and small arrays are cheap to pickle.
+_SHARED_THRESHOLD = 2 ** 16
+
+# The shared memory blocks used by shared arrays in this process, given by
+# their names, so that arrays sent several times to a process use the same
+# mapping of the memory.
+_SHARED_BLOCKS = weakref.WeakValueDictionary()
+
+
+class SharedArray(np.ndarray):
+    """
+    A Numpy array stored in shared memory by a numerical trait with
+    ``shared=True``.
+
+    Pickling a shared array (for instance when sending a ``HasTraits`` object
+    to a worker process) only pickles a handle to the shared memory, and
+    unpickling it attaches to the same memory without copying it, so that
+    processes share a single copy of the values. Views of a shared array are
+    pickled in the same way, but copies are pickled as normal arrays.
+
+    The ``metadata`` attribute gives the name, ``ndim``, ``shape``, ``dtype``
+    and ``domain`` of the trait that validated the values.
+
+    The shared memory is released once the array has been garbage collected
+    in the process that created it, so that process should keep the array
+    (or the object it is stored on) while other processes use it. Processes
+    attaching to the memory should be started with `multiprocessing` (or
+    `concurrent.futures.ProcessPoolExecutor`) from the creating process.
+    """
+
+    _shm = None
+    metadata = None
+
+    def __array_finalize__(self, obj):
+        if getattr(obj, '_shm', None) is not None and self.base is not None:
+            self._shm = obj._shm
+            self.metadata = obj.metadata
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # The results of operations on shared arrays are normal arrays
+        out = kwargs.get('out', ())
+        inputs = tuple(_plain_array(array) for array in inputs)
+        if out:
+            kwargs['out'] = tuple(_plain_array(array) for array in out)
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+        if out:
+            return out[0] if len(out) == 1 else out
+        return result
+
+    def __reduce__(self):
+        # Arrays derived from a shared array (for instance by ufuncs) may not
+        # use the shared memory, in which case they are pickled by value.
+        if self._shm is not None:
+            start = np.frombuffer(self._shm.buf, dtype=np.uint8, count=1).__array_interface__['data'][0]
+            low, high = _memory_bounds(self)
+            if start <= low and high <= start + self._shm.size:
+                offset = self.__array_interface__['data'][0] - start
+                return (_attach_shared, (self._shm.name, self.shape, self.dtype, self.strides,
+                                         offset, self.flags.writeable, self.metadata))
+        return self.view(np.ndarray).__reduce__()
+
+
+def _memory_bounds(array):
+    """
+    Return the addresses of the first byte and one past the last byte used by
+    an array.
+    """
+    low = high = array.__array_interface__['data'][0]
+    for size, stride in zip(array.shape, array.strides):
+        if size == 0:
+            return low, low
+        if stride < 0:
+            low += stride * (size - 1)
+        else:
+            high += stride * (size - 1)
+    return low, high + array.itemsize
+
+
+def _shared_copy(trait, value):
+    """
+    Copy a Numpy array validated by a trait into shared memory, returning a
+    `SharedArray`. Other values, and arrays that are already shared or that
+    are small, are returned as-is.
+    """
+
+    if type(value) is not np.ndarray or value.nbytes < _SHARED_THRESHOLD:
+        return value
+
+    from multiprocessing import shared_memory
+
+    spec = trait._spec
+
+    shm = shared_memory.SharedMemory(create=True, size=value.nbytes)
+    _SHARED_BLOCKS[shm.name] = shm
+
+    array = np.ndarray.__new__(SharedArray, value.shape, value.dtype, buffer=shm.buf)
+    array[...] = value
+    array._shm = shm
+    array.metadata = dict(name=trait.name, ndim=spec.ndim, shape=spec.shape,
+                          dtype=spec.dtype, domain=spec.domain)
+
+    # The array and any views of it keep the memory mapped. The name of the
+    # memory is removed once the array is no longer used, and the memory
+    # itself is freed once no process maps it anymore.
+    weakref.finalize(array, shm.unlink)
+
+    return array
+
+
+def _attach_shared(name, shape, dtype, strides, offset, writeable, metadata):
+    """
+    Return a `SharedArray` using the memory of a shared array pickled in
+    another process (or in this one).
+    """
+
+    shm = _SHARED_BLOCKS.get(name)
+    if shm is None:
+        from multiprocessing import shared_memory
+        shm = _SHARED_BLOCKS[name] = shared_memory.SharedMemory(name=name)
+
+    array = np.ndarray.__new__(SharedArray, shape, dtype, buffer=shm.buf,
+                               offset=offset, strides=strides)
+    array._shm = shm
+    array.metadata = metadata
+    if not writeable:
+        array.flags.writeable = False
+    return array
+
+
+# The pending values for objects inside a deferred() context, given by the id
+# of the object, and containing for each trait name the trait and the value
+# before the context was entered.
+_DEFERRED = {}
+
+# The values stored with _commit while trait notifications are held on an
+# object (see _held_notifications), given by the id of the object, and
+# containing the stored value for each trait name.
+_COMMITTED = {}
+
+
+@contextmanager
+def _held_notifications(obj):
+    """
+    Hold trait notifications on an object while values are stored with
+    `_commit`, as ``HasTraits.hold_trait_notifications`` does.
+
+    When the notifications are released, traitlets assigns the final values
+    again, which would validate them again, so numerical traits pass the
+    values stored with `_commit` through unchanged at that point. Any other
+    values, such as those assigned by observers, are validated as usual.
+    """
+
+    if id(obj) in _COMMITTED:
+        yield
+        return
+
+    _COMMITTED[id(obj)] = {}
+    try:
+        with obj.hold_trait_notifications():
+            yield
+    finally:
+        del _COMMITTED[id(obj)]
+
+
+@contextmanager
+def deferred(obj):
+    """
+    Defer the validation of numerical traits on an object.
+
+    Inside this context, values assigned to numerical traits on ``obj`` are
+    stored without being validated, and trait change notifications are held
+    (as with ``HasTraits.hold_trait_notifications``). When the context exits,
+    the final value of each numerical trait that was assigned is validated
+    once. If any values are invalid, all assignments are rolled back and a
+    `MultipleTraitErrors` exception giving the error for each trait is
+    raised::
+
+        with deferred(sphere):
+            sphere.radius = 3.
+            sphere.position = (1, 2, 3)
+    """
+
+    if id(obj) in _DEFERRED:
+        yield obj
+        return
+
+    with _held_notifications(obj):
+
+        pending = _DEFERRED[id(obj)] = {}
+
+        try:
+            yield obj
+        except BaseException:
+            # Make sure that no unvalidated values are left on the object
+            for name, (trait, old_value) in pending.items():
+                if old_value is Undefined:
+                    obj._trait_values.pop(name, None)
+                else:
+                    obj._trait_values[name] = old_value
+            raise
+        finally:
+            del _DEFERRED[id(obj)]
+
+        errors = {}
+        for name in sorted(pending):
+            trait = pending[name][0]
+            try:
+                value = trait.validate(obj, obj._trait_values[name])
+            except TraitError as exc:
+                errors[name] = exc.args[0]
+            else:
+                _commit(trait, obj, value)
+
+        if errors:
+            raise MultipleTraitErrors(errors)
+
+
+async def avalidate(obj, name, value, executor=None):
+    """
+    Validate and assign a value to a numerical trait without blocking the
+    event loop.
+
+    The value is validated in ``executor`` (or the default executor of the
+    event loop), so that other tasks can run while large arrays are being
+    converted and checked. Once the value is valid, it is assigned to the
+    trait in the event loop thread, and any observers are notified, as for a
+    normal assignment. If the value is invalid, a `TraitError` is raised and
+    the trait is left unchanged::
+
+        await avalidate(grid, 'values', values)
+
+    Parameters
+    ----------
+    obj : `traitlets.HasTraits`
+        The object to assign the value to.
+    name : str
+        The name of the numerical trait.
+    value : object
+        The value to validate and assign.
+    executor : `concurrent.futures.Executor`, optional
+        The executor in which to validate the value.
+
+    Returns
+    -------
+    value : object
+        The validated value that was assigned.
+    """
+
+    import asyncio
+
+    trait = getattr(type(obj), name, None)
+    if not isinstance(trait, NumericalTrait):
+        raise TraitError("{0} is not a numerical trait of {1}".format(name, type(obj).__name__))
+
+    # Plain numbers are validated faster than they could be handed over to
+    # the executor, and inside deferred() values are not validated yet.
+    if type(value) in _SCALAR_TYPES or id(obj) in _DEFERRED:
+        setattr(obj, name, value)
+        return obj._trait_values[name]
+
+    loop = asyncio.get_running_loop()
+    value = await loop.run_in_executor(executor, trait.validate, obj, value)
+
+    if obj._cross_validation_lock is False:
+        value = trait._cross_validate(obj, value)
+
+    _commit(trait, obj, value)
+
+    return value
+
+
+def _commit(trait, obj, value):
+    """
+    Store an already validated value for a trait on an object and notify any
+    observers, as ``TraitType.set`` does but without validating the value
+    again.
+    """
+    change = _store(trait, obj, value)
+    committed = _COMMITTED.get(id(obj))
+    if committed is not None:
+        committed[trait.name] = obj._trait_values[trait.name]
+    if change is not None:
+        obj._notify_trait(*change)
 
-        if self.target_unit is not None:
-            self.unit_framework = identify_unit_framework(self.target_unit)
 
-        # Check the construction arguments.
-        self._check_args()
+def _store(trait, obj, value):
+    """
+    Store an already validated value for a trait on an object, returning the
+    arguments with which to notify observers, or `None` if the value has not
+    changed.
+    """
 
-    def _check_args(self):
-        if self.shape is not None:
-            if self.ndim is None:
-                self.ndim = len(self.shape)
-            else:
-                if self.ndim != len(self.shape):
-                    raise TraitError("shape={0} and ndim={1} are inconsistent".format(self.shape, self.ndim))
+    try:
+        old_value = obj._trait_values[trait.name]
+    except KeyError:
+        old_value = trait.default_value
 
-    def validate(self, obj, value):
+    if trait._spec._stored:
+        value = _stored_value(trait, value)
 
-        # We proceed by checking whether Numpy tells us the value is a
-        # scalar. If Numpy isscalar returns False, it could still be scalar
-        # but be a Quantity with units, so we then extract the numerical
-        # values
-        if np.isscalar(value):
-            if not np.isreal(value):
-                raise TraitError("{0} should be a numerical value".format(self.name))
-            else:
-                is_scalar = True
-                num_value = value
-        else:
+    obj._trait_values[trait.name] = value
 
-            # The following works for Astropy and Pint quantities
+    # Comparing arrays with more than one element does not give a single
+    # boolean, so we avoid comparing them element by element for nothing.
+    if ((isinstance(value, np.ndarray) and value.size > 1) or
+            (isinstance(old_value, np.ndarray) and old_value.size > 1)):
+        silent = False
+    else:
+        try:
+            silent = bool(old_value == value)
+        except Exception:
+            silent = False
+
+    if silent is not True:
+        return trait.name, old_value, value
+
+
+def validate_records(cls, records, processes=None, chunk_size=1000):
+    """
+    Validate the numerical traits of many records in a pool of processes.
+
+    Each record is a dictionary of values to assign to an instance of
+    ``cls``. The values for the numerical traits of ``cls`` are validated in
+    chunks of records by worker processes, so that the validation of many
+    records is not limited to a single core by the GIL. The traits are sent
+    to the workers once, as the arguments needed to create them again. Other
+    values are returned unchanged. Cross-validation methods of ``cls`` are
+    not called.
+
+    The validated values can then be assigned without validating them again
+    using `assign_validated`.
+
+    Parameters
+    ----------
+    cls : subclass of `traitlets.HasTraits`
+        The class whose numerical traits should be used for the validation.
+    records : iterable of dict
+        The values to validate for each record.
+    processes : int, optional
+        The number of worker processes, which defaults to the number of CPUs.
+        If ``1``, the records are validated in the current process.
+    chunk_size : int, optional
+        The number of records to send to a worker at a time.
+
+    Returns
+    -------
+    results : list
+        For each record, in order, either a dictionary with the validated
+        values, or a `MultipleTraitErrors` exception giving the errors for
+        each invalid value.
+    """
+
+    arguments = dict((name, (type(trait), _trait_arguments(trait)))
+                     for name, trait in cls.class_traits().items()
+                     if isinstance(trait, NumericalTrait))
+
+    records = iter(records)
+    chunks = iter(lambda: list(islice(records, chunk_size)), [])
+
+    if processes == 1:
+        _init_record_worker(arguments)
+        try:
+            return [result for chunk in chunks for result in _validate_record_chunk(chunk)]
+        finally:
+            _RECORD_TRAITS.clear()
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    processes = processes or os.cpu_count() or 1
+    results = []
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_record_worker,
+                             initargs=(arguments,)) as executor:
+
+        # Only submit a few chunks per process at a time so that records are
+        # not all read into memory at once.
+        max_pending = 2 * processes
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_validate_record_chunk, chunk))
+            if len(pending) >= max_pending:
+                results.extend(pending.popleft().result())
+        while pending:
+            results.extend(pending.popleft().result())
+
+    return results
+
+
+def _trait_arguments(trait):
+    """
+    Return the arguments needed to create a numerical trait again.
+    """
+    spec = trait._spec
+    return dict(ndim=spec.ndim, shape=spec.shape, domain=spec.domain, default=spec.default,
+                convertible_to=spec.target_unit, conversion=spec.conversion,
+                dtype=spec.dtype, casting=spec.casting, cast=spec.cast, cache=spec.cache,
+                parallel=spec.parallel, convert=spec.convert, allow_nan=spec.allow_nan,
+                allow_inf=spec.allow_inf, constraints=spec.constraints,
+                validate_updates=spec.validate_updates, readonly=spec.readonly,
+                shared=spec.shared)
+
+
+# The numerical traits used to validate records in worker processes
+_RECORD_TRAITS = {}
+
+
+def _init_record_worker(arguments):
+    _RECORD_TRAITS.clear()
+    for name, (trait_class, kwargs) in arguments.items():
+        # Shared memory created by a worker would be released as soon as the
+        # worker no longer uses it, so values are only placed in shared memory
+        # once they are assigned with assign_validated.
+        trait = trait_class(**dict(kwargs, shared=False))
+        trait.name = name
+        _RECORD_TRAITS[name] = trait
+
+
+def _validate_record_chunk(records):
+    results = []
+    for record in records:
+        validated = {}
+        errors = {}
+        for name, value in record.items():
+            trait = _RECORD_TRAITS.get(name)
+            if trait is None:
+                validated[name] = value
+                continue
             try:
-                num_value = np.array(value, copy=False, dtype=float)
-            except Exception as exc:
-                raise TraitError("Could not convert value of {0} to a Numpy array (Exception: {1})".format(self.name, exc))
+                validated[name] = trait.validate(None, value)
+            except TraitError as exc:
+                errors[name] = exc.args[0]
+        results.append(MultipleTraitErrors(errors) if errors else validated)
+    return results
+
 
-            is_scalar = np.isscalar(num_value)
+def assign_validated(obj, values):
+    """
+    Assign values that have already been validated to the numerical traits of
+    an object, without validating them again.
 
-            if not is_scalar:
-                # If value is not scalar, then Pint and Astropy quantities will
-                # have a shape and ndim, so we can then safely set value to the
-                # unitless Numpy array if either shape or ndim are not present.
-                # This will cause e.g. tuples and lists to get converted.
-                if not hasattr(value, 'shape') or not hasattr(value, 'ndim'):
-                    value = num_value
+    This is intended for values returned by `validate_records`. Observers are
+    notified as for normal assignments. Values for other traits are assigned
+    normally.
 
-        if self.ndim is not None:
+    No checks at all are run on the values of numerical traits, so values
+    that did not come from `validate_records` (or that were modified since)
+    bypass every check, including the domain, shape, dtype and units, and
+    can leave the object in an invalid state.
 
-            if self.ndim == 0:
-                if not is_scalar:
-                    raise TraitError("{0} should be a scalar value".format(self.name))
+    Parameters
+    ----------
+    obj : `traitlets.HasTraits`
+        The object to assign the values to.
+    values : dict
+        The values to assign.
+    """
+    traits = obj.traits()
+    with _held_notifications(obj):
+        for name, value in values.items():
+            trait = traits.get(name)
+            if isinstance(trait, NumericalTrait):
+                _commit(trait, obj, value)
+            else:
+                setattr(obj, name, value)
 
-            if self.ndim > 0:
-                if is_scalar or num_value.ndim != self.ndim:
-                    if self.ndim == 1:
-                        raise TraitError("{0} should be a 1-d sequence".format(self.name))
-                    else:
-                        raise TraitError("{0} should be a {1:d}-d array".format(self.name, self.ndim))
 
-        if self.shape is not None:
+# Snapshot files start with a preamble giving the position and length of a
+# JSON footer that describes the saved values. The raw data of the values
+# follows the preamble, with each value aligned to _SNAPSHOT_ALIGNMENT bytes
+# so that it can be memory-mapped. Putting the description at the end means
+# that checksums can be computed while the data is being written.
+_SNAPSHOT_MAGIC = b'NTSNAP01'
+_SNAPSHOT_ALIGNMENT = 64
 
-            if self.shape is not None and np.any(num_value.shape != self.shape):
-                if self.ndim == 1:
-                    raise TraitError("{0} has incorrect length (expected {1} but found {2})".format(self.name, self.shape[0], num_value.shape[0]))
-                else:
-                    raise TraitError("{0} has incorrect shape (expected {1} but found {2})".format(self.name, self.shape, num_value.shape))
+# The types of values that can be saved in snapshots, apart from numbers
+_SNAPSHOT_ARRAYS = (np.ndarray, np.memmap, ValidatedArray, SharedArray)
+_SNAPSHOT_NUMBERS = {'bool': bool, 'int': int, 'float': float, 'complex': complex}
 
-        if self.target_unit is not None:
-            assert_unit_convertability(self.name, value, self.target_unit, self.unit_framework)
 
-        if is_scalar:
-            prefix = ""
+def save_snapshot(filename, objects):
+    """
+    Save the values of the numerical traits of one or more objects to a
+    snapshot file.
+
+    The values are written to a single file, in which the raw data of each
+    array is aligned so that it can be memory-mapped by `load_snapshot`. For
+    each value, the file records a fingerprint of the construction arguments
+    of the trait and a CRC32 checksum of the data, so that values can be
+    restored without validating them again if neither has changed. Only
+    numbers and Numpy arrays can be saved, so values with units are not
+    supported.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file to write.
+    objects : `traitlets.HasTraits` or list of `traitlets.HasTraits`
+        The object or objects whose values should be saved.
+    """
+
+    import json
+
+    if isinstance(objects, HasTraits):
+        objects = [objects]
+
+    records = []
+
+    # The snapshot is written to a temporary file which then replaces the
+    # target, so that an existing snapshot is left intact if a value cannot
+    # be saved or writing fails.
+    temporary = "{0}.{1}.tmp".format(filename, os.getpid())
+
+    try:
+        with open(temporary, 'wb') as f:
+
+            f.write(bytes(_SNAPSHOT_ALIGNMENT))
+
+            for obj in objects:
+                values = {}
+                for name, trait in sorted(obj.traits().items()):
+                    if isinstance(trait, NumericalTrait) and obj._trait_values.get(name) is not None:
+                        values[name] = _write_snapshot_value(f, trait, obj._trait_values[name])
+                records.append({'class': type(obj).__name__, 'values': values})
+
+            footer = json.dumps({'objects': records}).encode('utf-8')
+            position = f.tell()
+            f.write(footer)
+            f.seek(0)
+            f.write(_SNAPSHOT_MAGIC + position.to_bytes(8, 'little') + len(footer).to_bytes(8, 'little'))
+        os.replace(temporary, filename)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def _write_snapshot_value(f, trait, value):
+    """
+    Write the data of a value to a snapshot file, returning its description.
+    """
+
+    import zlib
+
+    if type(value) in _SNAPSHOT_NUMBERS.values():
+        kind = type(value).__name__
+    elif isinstance(value, np.generic):
+        kind = 'numpy'
+    elif type(value) in _SNAPSHOT_ARRAYS:
+        kind = 'array'
+    else:
+        kind = None
+
+    array = None if kind is None else np.asarray(value)
+    if array is None or array.dtype.kind not in 'biufc':
+        raise TraitError("{0} cannot be saved in a snapshot (only numbers and Numpy arrays are supported)".format(trait.name))
+
+    f.write(bytes(-f.tell() % _SNAPSHOT_ALIGNMENT))
+    offset = f.tell()
+
+    # Arrays that are not contiguous are written in blocks of rows, to avoid
+    # making a contiguous copy of the whole array.
+    if array.flags.c_contiguous or array.ndim == 0:
+        blocks = [array]
+    else:
+        step = max(1, _OUT_OF_CORE_BLOCK_SIZE // max(1, array[0].size))
+        blocks = (np.ascontiguousarray(array[start:start + step])
+                  for start in range(0, array.shape[0], step))
+
+    checksum = 0
+    for block in blocks:
+        data = block.reshape(-1).view(np.uint8)
+        checksum = zlib.crc32(data, checksum)
+        f.write(data)
+
+    return {'type': kind, 'dtype': array.dtype.str, 'shape': list(array.shape),
+            'offset': offset, 'crc32': checksum, 'spec': _spec_fingerprint(trait)}
+
+
+def _spec_fingerprint(trait):
+    """
+    Return a fingerprint of the class and construction arguments of a trait,
+    which changes if the rules used to validate values change.
+    """
+    import hashlib
+    arguments = _trait_arguments(trait)
+    arguments['constraints'] = [(type(constraint).__name__,
+                                 sorted((key, repr(value)) for key, value in vars(constraint).items()))
+                                for constraint in arguments['constraints'] or ()]
+    text = repr((__version__, type(trait).__module__, type(trait).__name__, sorted(arguments.items())))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def load_snapshot(filename, objects, verify=True, mmap_mode=None):
+    """
+    Restore the values of numerical traits saved with `save_snapshot`.
+
+    The values are assigned to the given objects, which should be the
+    objects (or objects of the same classes) that were saved, in the same
+    order. Values whose trait has the same construction arguments as when
+    the snapshot was saved, and whose data matches its checksum, are
+    assigned without being validated again, while other values are
+    validated as for a normal assignment. If any values are
+    invalid, no values are assigned and a `MultipleTraitErrors` exception is
+    raised. Observers are notified once all values of an object have been
+    assigned.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the snapshot file.
+    objects : `traitlets.HasTraits` or list of `traitlets.HasTraits`
+        The object or objects to assign the values to.
+    verify : bool, optional
+        Whether to compare the data to the checksums recorded in the file,
+        raising a `TraitError` if it has changed. If `False`, the data
+        cannot be trusted, so all values are validated instead.
+    mmap_mode : {None, 'r', 'c'}, optional
+        If set, arrays are memory-mapped from the file rather than read into
+        memory, either read-only (``'r'``) or copy-on-write (``'c'``), as for
+        `numpy.load`.
+    """
+
+    import json
+    import mmap
+    import zlib
+
+    single = isinstance(objects, HasTraits)
+    if single:
+        objects = [objects]
+
+    if mmap_mode not in (None, 'r', 'c'):
+        raise TraitError("mmap_mode should be one of None, 'r', or 'c'")
+
+    with open(filename, 'rb') as f:
+
+        preamble = f.read(24)
+        if preamble[:8] != _SNAPSHOT_MAGIC:
+            raise TraitError("{0} is not a numtraits snapshot".format(filename))
+
+        # The footer should follow the data, at the end of the file
+        position = int.from_bytes(preamble[8:16], 'little')
+        length = int.from_bytes(preamble[16:24], 'little')
+        if len(preamble) < 24 or position < _SNAPSHOT_ALIGNMENT or position + length != os.fstat(f.fileno()).st_size:
+            raise TraitError("{0} is truncated or corrupt".format(filename))
+        f.seek(position)
+        try:
+            records = json.loads(f.read(length).decode('utf-8'))['objects']
+        except (ValueError, KeyError, TypeError):
+            raise TraitError("{0} is truncated or corrupt".format(filename))
+
+        if len(records) != len(objects):
+            raise TraitError("{0} contains {1} objects but {2} were given".format(filename, len(records), len(objects)))
+
+        if mmap_mode is None:
+            buffer = None
         else:
-            prefix = "All values of "
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ if mmap_mode == 'r' else mmap.ACCESS_COPY)
 
-        if self.domain == 'positive':
-            if np.any(num_value < 0.):
-                raise TraitError(prefix + "{0} should be positive".format(self.name))
-        elif self.domain == 'strictly-positive':
-            if np.any(num_value <= 0.):
-                raise TraitError(prefix + "{0} should be strictly positive".format(self.name))
-        elif self.domain == 'negative':
-            if np.any(num_value > 0.):
-                raise TraitError(prefix + "{0} should be negative".format(self.name))
-        elif self.domain == 'strictly-negative':
-            if np.any(num_value >= 0.):
-                raise TraitError(prefix + "{0} should be strictly negative".format(self.name))
-        elif type(self.domain) in [tuple, list] and len(self.domain) == 2:
-            if np.any(num_value < self.domain[0]) or np.any(num_value > self.domain[-1]):
-                raise TraitError(prefix + "{0} should be in the range [{1:g}:{2:g}]".format(self.name, self.domain[0], self.domain[-1]))
+        pending = []
+        errors = {}
 
-        return value
+        for index, (obj, record) in enumerate(zip(objects, records)):
+            if record.get('class') != type(obj).__name__:
+                raise TraitError("{0} was saved from an object of class {1} but an object of class {2} was given".format(filename, record.get('class'), type(obj).__name__))
+            traits = obj.traits()
+            values = []
+            for name, entry in sorted(record['values'].items()):
+                trait = traits.get(name)
+                if not isinstance(trait, NumericalTrait):
+                    raise TraitError("{0} is not a numerical trait of {1}".format(name, type(obj).__name__))
+                array = _read_snapshot_array(f, buffer, entry, position)
+                if verify and zlib.crc32(array.reshape(-1).view(np.uint8)) != entry['crc32']:
+                    raise TraitError("The data for {0} in {1} does not match its checksum".format(name, filename))
+                if entry['type'] == 'array':
+                    value = array
+                elif entry['type'] == 'numpy':
+                    value = array[()]
+                else:
+                    value = _SNAPSHOT_NUMBERS[entry['type']](array[()])
+                if not verify or entry['spec'] != _spec_fingerprint(trait):
+                    try:
+                        value = trait._validate(obj, value)
+                    except TraitError as exc:
+                        errors[name if single else (index, name)] = exc.args[0]
+                        continue
+                values.append((trait, value))
+            pending.append(values)
+
+    if errors:
+        raise MultipleTraitErrors(errors)
+
+    # Observers are notified once all the values of an object are stored. This
+    # avoids hold_trait_notifications, which would compare the arrays to
+    # themselves when the notifications are released.
+    for obj, values in zip(objects, pending):
+        changes = [_store(trait, obj, value) for trait, value in values]
+        for change in changes:
+            if change is not None:
+                obj._notify_trait(*change)
+
+
+def _read_snapshot_array(f, buffer, entry, end):
+    """
+    Read the array for a value in a snapshot, either from the file or from a
+    memory-mapped buffer. The data should end before the position ``end``.
+    """
+    try:
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        count = int(np.prod(shape, dtype=int))
+        offset = entry['offset']
+    except (KeyError, TypeError, ValueError):
+        raise TraitError("{0} is truncated or corrupt".format(f.name))
+    if offset < _SNAPSHOT_ALIGNMENT or offset + count * dtype.itemsize > end:
+        raise TraitError("{0} is truncated or corrupt".format(f.name))
+    if buffer is not None:
+        return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+    array = np.empty(shape, dtype=dtype)
+    f.seek(offset)
+    f.readinto(array.reshape(-1).view(np.uint8))
+    return array
+
+
+# The policies for converting values to Numpy arrays: 'never-copy' means that
+# values which cannot be used without making a copy are rejected,
+# 'copy-if-needed' means that values are only copied if they need to be
+# converted to a Numpy array, and 'always-copy' means that a copy is always
+# stored so that later changes to the original value have no effect.
+CONVERSION_POLICIES = ('never-copy', 'copy-if-needed', 'always-copy')
+
+
+def _numerical_array(value, kinds='biuf', sequence_dtype=float):
+    """
+    Return the numerical values of a value as a Numpy array, and whether a
+    copy had to be made.
+
+    Numpy arrays (including quantities) and objects supporting the buffer
+    protocol with a dtype of one of the given ``kinds`` are returned as views
+    without copying or changing the dtype. Other values (such as lists and
+    tuples) are converted to arrays with ``sequence_dtype`` (or the dtype
+    inferred by Numpy if `None`). Values which do not end up with one of the
+    given kinds are converted to floats.
+    """
+
+    if _has_magnitude(value):
+        value = value.magnitude
+
+    # Out-of-core arrays are not read into memory here - instead, they are
+    # checked in blocks using their shape, ndim, and dtype attributes.
+    if _is_out_of_core(value):
+        if value.dtype.kind not in kinds:
+            raise TypeError("out-of-core arrays with dtype {0} are not supported".format(value.dtype))
+        return value, False
 
-try:
-    import astropy.units
-except ImportError:  # pragma: no cover
-    HAS_ASTROPY = False
-else:
-    HAS_ASTROPY = True
+    if isinstance(value, np.ndarray) or _supports_buffer(value):
+        array = np.asarray(value)
+        copied = False
+    else:
+        array = np.asarray(value, dtype=sequence_dtype)
+        copied = True
 
-try:
-    import pint
-except ImportError:  # pragma: no cover
-    HAS_PINT = False
-else:
-    HAS_PINT = True
+    if array.dtype.kind in kinds:
+        return array, copied
+    else:
+        return array.astype(float), True
 
 
-try:
-    import quantities
-except ImportError:  # pragma: no cover
-    HAS_QUANTITIES = False
-else:
-    HAS_QUANTITIES = True
+def _is_out_of_core(value):
+    """
+    Whether a value is a chunked array-like object, such as an h5py Dataset or
+    a zarr or dask array, that should be read from in blocks.
+    """
+    return (not isinstance(value, np.ndarray) and hasattr(value, 'chunks') and
+            hasattr(value, 'shape') and hasattr(value, 'ndim') and hasattr(value, 'dtype'))
+
+
+def _is_stream(value):
+    """
+    Whether a value is an iterable of unknown length, such as a generator.
+    """
+    return (hasattr(value, '__iter__') and not hasattr(value, '__len__') and
+            not hasattr(value, 'shape'))
+
+
+def _has_magnitude(value):
+    # Pint and quantities Quantity objects store their values in magnitude
+    return hasattr(value, 'magnitude') and hasattr(value, 'units')
+
+
+def _supports_buffer(value):
+    if isinstance(value, (list, tuple, str)):
+        return False
+    try:
+        memoryview(value)
+    except TypeError:
+        return False
+    else:
+        return True
+
+
+# The casting rules that can be used when checking the dtype of values, as
+# defined by numpy.can_cast.
+CASTING_RULES = ('no', 'equiv', 'safe', 'same_kind', 'unsafe')
+
+# The named domains, given as (lower, upper, lower_strict, upper_strict) bounds
+# along with the text used in error messages.
+_DOMAIN_BOUNDS = {
+    'positive': ((0., None, False, False), "should be positive"),
+    'strictly-positive': ((0., None, True, False), "should be strictly positive"),
+    'negative': ((None, 0., False, False), "should be negative"),
+    'strictly-negative': ((None, 0., False, True), "should be strictly negative"),
+}
+
+# Number of elements to process at a time when checking large arrays. This
+# keeps temporary arrays small enough to stay in the CPU cache, so that each
+# block is only read once from main memory.
+_BLOCK_SIZE = 65536
+
+# Number of elements to read at a time from out-of-core arrays, which is larger
+# to reduce the overhead of each read.
+_OUT_OF_CORE_BLOCK_SIZE = 2 ** 20
+
+
+def _iter_blocks(array, block_size=_BLOCK_SIZE):
+    """
+    Iterate over the values of an array in 1-d blocks.
+
+    Contiguous Numpy arrays are split into views of ``block_size`` elements.
+    For non-contiguous or out-of-core arrays, blocks of rows are taken along
+    the first axis, so that at most ``block_size`` elements are copied or read
+    into memory at a time.
+    """
+
+    if isinstance(array, np.ndarray):
+        size = array.size
+    else:
+        size = int(np.prod(array.shape))
+
+    if size == 0:
+        return
+
+    if isinstance(array, np.ndarray) and (array.flags.c_contiguous or array.flags.f_contiguous):
+        flat = array.ravel(order='K')
+        for start in range(0, flat.size, block_size):
+            yield flat[start:start + block_size]
+        return
+
+    if array.ndim == 0:
+        yield np.asarray(array[()]).reshape(1)
+        return
+
+    row_size = size // array.shape[0]
+
+    if row_size > block_size:
+        for index in range(array.shape[0]):
+            for block in _iter_blocks(array[index], block_size=block_size):
+                yield block
+    else:
+        n_rows = block_size // row_size
+        for start in range(0, array.shape[0], n_rows):
+            yield np.asarray(array[start:start + n_rows]).ravel()
+
+
+def _bounds_violation(values, lower=None, upper=None, lower_strict=False, upper_strict=False,
+                      allow_nan=True, allow_inf=True):
+    """
+    Find whether any values are NaN, infinite, or outside the specified bounds.
+
+    Arrays are checked block by block with min/max reductions, so that no
+    full-size temporary arrays are needed and each value is only read once
+    from memory. NaN and infinite values are detected with the same
+    reductions as the bounds, since NaN values propagate through
+    ``np.minimum`` and infinite values are the extreme values of a block.
+
+    Parameters
+    ----------
+    values : scalar, `numpy.ndarray`, or out-of-core array
+        The values to check.
+    lower, upper : float or None
+        The lower and upper bounds, or `None` if unbounded.
+    lower_strict, upper_strict : bool
+        Whether values are allowed to be equal to the bounds.
+    allow_nan, allow_inf : bool
+        Whether NaN and infinite values are allowed. If NaN values are
+        allowed, they are ignored when checking the bounds.
+
+    Returns
+    -------
+    violation : str or None
+        ``'nan'``, ``'inf'``, or ``'range'`` for the first problem found, or
+        `None` if all values are valid.
+    """
+
+    if lower is None and upper is None and getattr(values, 'dtype', None) is not None:
+        if values.dtype.kind in 'biu':  # integers cannot be NaN or infinite
+            return None
+
+    if isinstance(values, np.ndarray):
+        blocks = _iter_blocks(values)
+    elif _is_out_of_core(values):
+        blocks = _iter_blocks(values, block_size=_OUT_OF_CORE_BLOCK_SIZE)
+    else:
+        blocks = None
+
+    if blocks is None:
+        blocks = [values]
+        minimum = maximum = lambda x: x
+    elif allow_nan:
+        minimum, maximum = np.fmin.reduce, np.fmax.reduce
+    else:
+        minimum, maximum = np.minimum.reduce, np.maximum.reduce
+
+    use_minimum = lower is not None or not allow_nan or not allow_inf
+    use_maximum = upper is not None or not allow_inf
+
+    for block in blocks:
+        if use_minimum:
+            low = minimum(block)
+            if not allow_nan and low != low:
+                return 'nan'
+        if use_maximum:
+            high = maximum(block)
+        if not allow_inf and (low == -np.inf or high == np.inf):
+            return 'inf'
+        if lower is not None and (low < lower or (lower_strict and low == lower)):
+            return 'range'
+        if upper is not None and (high > upper or (upper_strict and high == upper)):
+            return 'range'
+
+    return None
+
+
+# Error messages for NaN and infinite values
+_VIOLATION_TEXT = {
+    'nan': "should not be NaN",
+    'inf': "should not be infinite",
+}
+
+
+# Arrays with at least this many elements are checked in parallel by traits
+# with parallel=True, using a thread pool that is only created when first
+# needed. Smaller arrays are checked faster in a single thread.
+_PARALLEL_THRESHOLD = 2 ** 22
+_NUM_THREADS = None
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def set_num_threads(n_threads=None):
+    """
+    Set the number of threads used to check the domain of large arrays.
+
+    This only applies to traits defined with ``parallel=True``.
+
+    Parameters
+    ----------
+    n_threads : int or None
+        The number of threads, or `None` to use one per CPU.
+    """
+    global _NUM_THREADS, _EXECUTOR
+    if n_threads is not None and n_threads < 1:
+        raise TraitError("n_threads should be at least 1")
+    # The previous pool is not shut down, since other threads may still be
+    # submitting checks to it. Its threads exit once it is no longer used.
+    with _EXECUTOR_LOCK:
+        _EXECUTOR = None
+        _NUM_THREADS = n_threads
+
+
+def _get_executor():
+    """
+    Return the pool of threads used to check large arrays, and its number of
+    threads.
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _EXECUTOR = ThreadPoolExecutor(max_workers=_NUM_THREADS or os.cpu_count() or 1,
+                                           thread_name_prefix='numtraits')
+        return _EXECUTOR, _EXECUTOR._max_workers
+
+
+def _bounds_violation_parallel(values, *bounds):
+    """
+    Find whether any values are NaN, infinite, or outside the specified
+    bounds, splitting large Numpy arrays into parts that are checked
+    concurrently.
+
+    Numpy releases the GIL during the min/max reductions, so the parts are
+    checked by a pool of threads. Arrays smaller than ``_PARALLEL_THRESHOLD``
+    elements, and other values, are checked with `_bounds_violation`.
+    """
+
+    if (not isinstance(values, np.ndarray) or values.size < _PARALLEL_THRESHOLD or
+            values.ndim == 0 or (_NUM_THREADS or os.cpu_count()) == 1):
+        return _bounds_violation(values, *bounds)
+
+    # We keep a reference to the pool, which may be replaced by another
+    # thread calling set_num_threads while the parts are being checked.
+    executor, n_threads = _get_executor()
+
+    # Split contiguous arrays evenly, and other arrays along the first axis.
+    # Using a few parts per thread keeps the threads busy if some finish
+    # early, and lets us stop sooner once a part is invalid.
+    if values.flags.c_contiguous or values.flags.f_contiguous:
+        values = values.ravel(order='K')
+    parts = np.array_split(values, min(4 * n_threads, values.shape[0]))
+
+    futures = [executor.submit(_bounds_violation, part, *bounds) for part in parts]
+    try:
+        for future in futures:
+            violation = future.result()
+            if violation is not None:
+                return violation
+    finally:
+        for future in futures:
+            future.cancel()
+
+    return None
+
+
+def _rows_within_bounds(values, lower=None, upper=None, lower_strict=False, upper_strict=False,
+                        allow_nan=True, allow_inf=True):
+    """
+    Check whether the values in each row of a 2-d array are valid (see
+    `_bounds_violation`), returning a boolean array with one element per row.
+    """
+
+    valid = np.ones(values.shape[0], dtype=bool)
+
+    if allow_nan:
+        minimum, maximum = np.fmin.reduce, np.fmax.reduce
+    else:
+        minimum, maximum = np.minimum.reduce, np.maximum.reduce
+
+    low = high = None
+
+    if lower is not None or not allow_nan or not allow_inf:
+        low = minimum(values, axis=1)
+        if not allow_nan:
+            valid &= low == low
+        if not allow_inf:
+            valid &= low != -np.inf
+        if lower is not None:
+            in_range = low >= lower
+            if lower_strict:
+                in_range &= low != lower
+            valid &= in_range if not allow_nan else in_range | np.isnan(low)
+
+    if upper is not None or not allow_inf:
+        high = maximum(values, axis=1)
+        if not allow_inf:
+            valid &= high != np.inf
+        if upper is not None:
+            in_range = high <= upper
+            if upper_strict:
+                in_range &= high != upper
+            valid &= in_range if not allow_nan else in_range | np.isnan(high)
+
+    return valid
+
+
+def _violated_constraint(values, constraints):
+    """
+    Return the first constraint that is not satisfied by the values, or
+    `None` if all the constraints are satisfied.
+
+    If possible, the constraints are all checked on one block of rows at a
+    time, so that large arrays are only read once from memory.
+    """
+
+    values = np.asanyarray(values) if not _is_out_of_core(values) else values
+
+    if values.ndim > 1 and values.size > 0 and all(constraint.splittable(values.ndim) for constraint in constraints):
+        row_size = max(1, values.size // values.shape[0])
+        n_rows = max(1, _BLOCK_SIZE // row_size)
+        for start in range(0, values.shape[0], n_rows):
+            block = np.asarray(values[start:start + n_rows])
+            for constraint in constraints:
+                if not constraint.check(block):
+                    return constraint
+        return None
+
+    values = np.asarray(values)
+    for constraint in constraints:
+        if not constraint.check(values):
+            return constraint
+    return None
+
+
+# The unit frameworks are not imported here since they can take a long time to
+# import. Instead, we only look at them once a unit or a value from one of
+# them is used, at which point the framework will already have been imported.
+_UNIT_PACKAGES = {
+    'HAS_ASTROPY': 'astropy',
+    'HAS_PINT': 'pint',
+    'HAS_QUANTITIES': 'quantities',
+}
+
+
+def __getattr__(name):
+    # Determine HAS_ASTROPY, HAS_PINT, and HAS_QUANTITIES on request without
+    # importing the frameworks.
+    if name in _UNIT_PACKAGES:
+        from importlib.util import find_spec
+        return find_spec(_UNIT_PACKAGES[name]) is not None
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
 
 def identify_unit_framework(target_unit):
     """
     Identify whether the user is requesting unit validation against
     astropy.units, pint, or quantities.
+
+    Frameworks that have not been imported are skipped, since the target unit
+    cannot come from them.
     """
 
-    if HAS_ASTROPY:
+    if 'astropy.units' in sys.modules:
 
         from astropy.units import UnitBase
 
@@ -178,15 +2703,15 @@ def identify_unit_framework(target_unit):
 
             return ASTROPY
 
-    if HAS_PINT:
+    if 'pint' in sys.modules:
 
-        from pint.unit import UnitsContainer
+        from pint.util import UnitsContainer
 
         if hasattr(target_unit, 'dimensionality') and isinstance(target_unit.dimensionality, UnitsContainer):
 
             return PINT
 
-    if HAS_QUANTITIES:
+    if 'quantities' in sys.modules:
 
         from quantities.unitquantity import IrreducibleUnit
         from quantities import Quantity
@@ -203,7 +2728,9 @@ def assert_unit_convertability(name, value, target_unit, unit_framework):
     Check that a value has physical type consistent with user-specified units
 
     Note that this does not convert the value, only check that the units have
-    the right physical dimensionality.
+    the right physical dimensionality. Whether two units are equivalent is
+    cached, so that repeated checks with the same units do not need to go
+    through the unit framework (see `unit_cache_info`).
 
     Parameters
     ----------
@@ -224,12 +2751,12 @@ def assert_unit_convertability(name, value, target_unit, unit_framework):
         if not isinstance(value, Quantity):
             raise TraitError("{0} should be given as an Astropy Quantity instance".format(name))
 
-        if not target_unit.is_equivalent(value.unit):
+        if not _equivalent_units(ASTROPY, target_unit, value.unit):
             raise TraitError("{0} should be in units convertible to {1}".format(name, target_unit))
 
     elif unit_framework == PINT:
 
-        from pint.unit import UnitsContainer
+        from pint.util import UnitsContainer
 
         if not (hasattr(value, 'dimensionality') and isinstance(value.dimensionality, UnitsContainer)):
             raise TraitError("{0} should be given as a Pint Quantity instance".format(name))
@@ -244,5 +2771,97 @@ def assert_unit_convertability(name, value, target_unit, unit_framework):
         if not isinstance(value, Quantity):
             raise TraitError("{0} should be given as a quantities Quantity instance".format(name))
 
-        if value.dimensionality.simplified != target_unit.dimensionality.simplified:
+        if not _equivalent_units(QUANTITIES, target_unit.dimensionality, value.dimensionality):
             raise TraitError("{0} should be in units convertible to {1}".format(name, target_unit.dimensionality.string))
+
+
+# Maximum number of (target unit, unit) pairs for which to remember whether
+# they are equivalent.
+_UNIT_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=_UNIT_CACHE_SIZE)
+def _cached_equivalent_units(unit_framework, target_unit, unit):
+    if unit_framework == ASTROPY:
+        return target_unit.is_equivalent(unit)
+    else:
+        return target_unit.simplified == unit.simplified
+
+
+def _equivalent_units(unit_framework, target_unit, unit):
+    """
+    Check whether two units (or for quantities, dimensionalities) are
+    equivalent, using a cache of previous results if the units are hashable.
+    """
+    try:
+        return _cached_equivalent_units(unit_framework, target_unit, unit)
+    except TypeError:  # unhashable units
+        return _cached_equivalent_units.__wrapped__(unit_framework, target_unit, unit)
+
+
+@lru_cache(maxsize=_UNIT_CACHE_SIZE)
+def _cached_conversion_factors(unit_framework, target_unit, unit):
+    values = np.array([0., 1.])
+    if unit_framework == ASTROPY:
+        converted = (values * unit).to_value(target_unit)
+    elif unit_framework == PINT:
+        registry = target_unit._REGISTRY
+        converted = registry.Quantity(values, unit).to(target_unit).magnitude
+    else:
+        from quantities import Quantity
+        converted = Quantity(values, unit).rescale(target_unit).magnitude
+    offset = float(converted[0])
+    return float(converted[1]) - offset, offset
+
+
+def _conversion_factors(unit_framework, target_unit, unit):
+    """
+    Return the scale factor and offset needed to convert values from a unit
+    (or for quantities, a dimensionality) to a target unit, using a cache of
+    previous results if the units are hashable.
+    """
+    try:
+        return _cached_conversion_factors(unit_framework, target_unit, unit)
+    except (TypeError, ValueError):  # unhashable units, or pint units from different registries
+        return _cached_conversion_factors.__wrapped__(unit_framework, target_unit, unit)
+
+
+def _value_unit(unit_framework, value):
+    if unit_framework == ASTROPY:
+        return value.unit
+    elif unit_framework == PINT:
+        return value.units
+    else:
+        return value.dimensionality
+
+
+def _with_units(unit_framework, value, magnitude, target_unit):
+    """
+    Return a quantity of the same framework as ``value`` with the given
+    magnitude in the target unit.
+    """
+    if unit_framework == ASTROPY:
+        from astropy.units import Quantity
+        return Quantity(magnitude, target_unit, copy=False)
+    elif unit_framework == PINT:
+        return type(value)(magnitude, target_unit)
+    else:
+        from quantities import Quantity
+        return Quantity(magnitude, target_unit, copy=False)
+
+
+def unit_cache_info():
+    """
+    Return the hits, misses, maximum size and current size of the cache used
+    to remember which units are equivalent.
+    """
+    return _cached_equivalent_units.cache_info()
+
+
+def clear_unit_cache():
+    """
+    Clear the caches used to remember which units are equivalent and the
+    factors needed to convert between units.
+    """
+    _cached_equivalent_units.cache_clear()
+    _cached_conversion_factors.cache_clear()
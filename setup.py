@@ -24,5 +24,6 @@ setup(
     license='BSD',
     author='Thomas Robitaille',
     author_email='thomas.robitaille@gmail.com',
+    python_requires='>=3.8',
     install_requires=['numpy','traitlets']
 )
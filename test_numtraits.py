@@ -1,9 +1,23 @@
+import os
+import sys
+import pickle
+import threading
+import warnings
+import asyncio
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import pytest
 
 import numpy as np
-from numtraits import NumericalTrait
+from numtraits import (NumericalTrait, MultipleTraitErrors, deferred, avalidate,
+                       validate_records, assign_validated, save_snapshot, load_snapshot,
+                       enable_profiling, disable_profiling, reset_profiling,
+                       get_profile, profile_table, mark_dirty, set_num_threads,
+                       unit_cache_info, clear_unit_cache, Range, Monotonic, SumsTo,
+                       ValidatedArray, SharedArray, _bounds_violation)
 
-from traitlets import HasTraits, TraitError
+from traitlets import HasTraits, TraitError, Unicode, observe, validate
 
 class ScalarProperties(HasTraits):
 
@@ -186,6 +200,7 @@ else:
 
         a = NumericalTrait(convertible_to=u.m)
         b = NumericalTrait(convertible_to=u.cm / u.s)
+        c = NumericalTrait(convertible_to=u.m, convert=True)
 
     class TestAstropyUnits(object):
 
@@ -235,10 +250,89 @@ else:
                 self.aup.b = np.ones((2, 5)) * u.s
             assert exc.value.args[0] == 'b should be in units convertible to cm / s'
 
+        def test_validate_many(self):
+
+            AstropyUnitsProperties.a.validate_many(np.ones((3, 2)) * u.km)
+            AstropyUnitsProperties.a.validate_many([1 * u.km, [1, 2] * u.m])
+
+            with pytest.raises(MultipleTraitErrors) as exc:
+                AstropyUnitsProperties.a.validate_many(np.ones(2) * u.s)
+            assert exc.value.errors == {0: 'a should be in units convertible to m',
+                                        1: 'a should be in units convertible to m'}
+
+            with pytest.raises(MultipleTraitErrors) as exc:
+                AstropyUnitsProperties.a.validate_many([1 * u.km, 2 * u.s])
+            assert exc.value.errors == {1: 'a should be in units convertible to m'}
+
+        def test_convert_domain(self):
+
+            # The domain is given in the units that values are converted to
+
+            class Properties(HasTraits):
+                a = NumericalTrait(convertible_to=u.m, convert=True, domain=(0, 1000))
+
+            p = Properties()
+            p.a = 5000 * u.mm
+            assert p.a.unit == u.m
+            with pytest.raises(TraitError) as exc:
+                p.a = 3 * u.km
+            assert exc.value.args[0] == "All values of a should be in the range [0:1000]"
+            with pytest.raises(TraitError) as exc:
+                p.a = [1, 3] * u.km
+            assert exc.value.args[0] == "All values of a should be in the range [0:1000]"
+            with pytest.raises(MultipleTraitErrors) as exc:
+                Properties.a.validate_many([3, 0.5] * u.km)
+            assert exc.value.errors == {0: "All values of a should be in the range [0:1000]"}
+            with pytest.raises(MultipleTraitErrors) as exc:
+                Properties.a.validate_many([5000 * u.mm, 3 * u.km])
+            assert exc.value.errors == {1: "All values of a should be in the range [0:1000]"}
+
+        def test_unit_cache(self):
+
+            clear_unit_cache()
+
+            self.aup.a = 3 * u.km
+            assert unit_cache_info().misses == 1
+
+            self.aup.a = [1, 2, 3] * u.km
+            self.aup.a = 4 * u.km
+            info = unit_cache_info()
+            assert info.hits == 2
+            assert info.misses == 1
+
+            with pytest.raises(TraitError):
+                self.aup.a = 5 * u.s
+            with pytest.raises(TraitError):
+                self.aup.a = 5 * u.s
+            info = unit_cache_info()
+            assert info.hits == 3
+            assert info.misses == 2
+
+        def test_convert(self):
+
+            self.aup.c = 3 * u.km
+            assert self.aup.c.unit == u.m
+            assert self.aup.c.value == 3000.
+
+            values = [1, 2, 3] * u.cm
+            self.aup.c = values
+            assert self.aup.c.unit == u.m
+            np.testing.assert_allclose(self.aup.c.value, [0.01, 0.02, 0.03])
+            assert values.unit == u.cm
+
+            values = [1, 2] * u.m
+            self.aup.c = values
+            assert self.aup.c is values
+
+            converted = AstropyUnitsProperties.c.validate_many(np.ones((2, 3)) * u.km)
+            assert converted.unit == u.m
+            np.testing.assert_allclose(converted.value, 1000.)
+
     class PintUnitsProperties(HasTraits):
 
         a = NumericalTrait(convertible_to=ureg.m)
         b = NumericalTrait(convertible_to=ureg.cm / ureg.s)
+        c = NumericalTrait(convertible_to=ureg.K, convert=True)
 
     class TestPintUnits(object):
 
@@ -292,10 +386,22 @@ else:
                 self.pup.b = np.ones((2, 5)) * ureg.s
             assert exc.value.args[0] == 'b should be in units convertible to centimeter / second'
 
+        def test_convert(self):
+
+            self.pup.c = 3 * ureg.mK
+            assert self.pup.c.units == ureg.K
+            assert self.pup.c.magnitude == pytest.approx(0.003)
+
+            # Temperatures with offsets
+            self.pup.c = ureg.Quantity(np.array([0., 100.]), ureg.degC)
+            assert self.pup.c.units == ureg.K
+            np.testing.assert_allclose(self.pup.c.magnitude, [273.15, 373.15])
+
     class QuantitiesUnitsProperties(HasTraits):
 
         a = NumericalTrait(convertible_to=pq.m)
         b = NumericalTrait(convertible_to=pq.cm / pq.s)
+        c = NumericalTrait(convertible_to=pq.m, convert=True)
 
     class TestQuantitiesUnits(object):
 
@@ -349,6 +455,26 @@ else:
                 self.qup.b = np.ones((2, 5)) * pq.s
             assert exc.value.args[0] == 'b should be in units convertible to cm/s'
 
+        def test_unit_cache(self):
+
+            clear_unit_cache()
+
+            self.qup.b = [1, 2, 3] * pq.km / pq.s
+            self.qup.b = 3 * pq.km / pq.s
+            info = unit_cache_info()
+            assert info.hits == 1
+            assert info.misses == 1
+
+        def test_convert(self):
+
+            self.qup.c = 3 * pq.km
+            assert self.qup.c.dimensionality == pq.m.dimensionality
+            assert float(self.qup.c.magnitude) == 3000.
+
+            self.qup.c = [1, 2] * pq.cm
+            assert self.qup.c.dimensionality == pq.m.dimensionality
+            np.testing.assert_allclose(self.qup.c.magnitude, [0.01, 0.02])
+
 
 
 # TODO: add test for domain with units
@@ -360,8 +486,1592 @@ def test_inconsistent_ndim_shape():
     assert exc.value.args[0] == "shape=(3, 3) and ndim=3 are inconsistent"
 
 
+def test_convert_without_units():
+
+    with pytest.raises(TraitError) as exc:
+        a = NumericalTrait(convert=True)
+    assert exc.value.args[0] == "convertible_to should be specified if convert=True"
+
+
 def test_invalid_unit_framework():
 
     with pytest.raises(TraitError) as exc:
         a = NumericalTrait(convertible_to='m')
     assert exc.value.args[0] == "Could not identify unit framework for target unit of type str"
+
+
+def test_domain_and_shape_as_lists():
+
+    class ListProperties(HasTraits):
+        a = NumericalTrait(shape=[3], domain=[3, 4])
+
+    lp = ListProperties()
+    lp.a = (3., 3.5, 4.)
+    with pytest.raises(TraitError) as exc:
+        lp.a = (3., 3.5, 5.)
+    assert exc.value.args[0] == "All values of a should be in the range [3:4]"
+
+
+def test_recompile_after_changing_args():
+
+    class Properties(HasTraits):
+        a = NumericalTrait(ndim=0)
+
+    p = Properties()
+    p.a = -1.
+
+    Properties.a.domain = 'positive'
+
+    with pytest.raises(TraitError) as exc:
+        p.a = -1.
+    assert exc.value.args[0] == "a should be positive"
+
+    Properties.a.domain = 'negative'
+    p.a = -1.
+
+    with pytest.raises(TraitError) as exc:
+        Properties.a.shape = (3, 3)
+    assert exc.value.args[0] == "shape=(3, 3) and ndim=0 are inconsistent"
+    assert Properties.a.shape is None
+
+
+class TestDomainBlocks(object):
+
+    def setup_method(self, method):
+
+        self.ap = ArrayProperties()
+
+    def test_large(self):
+        values = np.linspace(3., 4., 300000)
+        self.ap.f = values
+        values[-1] = 4.5
+        with pytest.raises(TraitError) as exc:
+            self.ap.f = values
+        assert exc.value.args[0] == "All values of f should be in the range [3:4]"
+
+    def test_non_contiguous(self):
+        values = np.ones((1000, 300))
+        values[500, 1] = -1.
+        self.ap.b = values[:, 0]
+        with pytest.raises(TraitError) as exc:
+            self.ap.b = values[:, 1]
+        assert exc.value.args[0] == "All values of b should be positive"
+        assert _bounds_violation(values[:, ::2], 0.) is None
+        assert _bounds_violation(values[:, 1::2], 0.) == 'range'
+        assert _bounds_violation(values.T[1::2], 0.) == 'range'
+
+    def test_nan(self):
+        with pytest.raises(TraitError) as exc:
+            self.ap.b = np.array([np.nan, -5.])
+        assert exc.value.args[0] == "All values of b should be positive"
+
+    def test_empty(self):
+        self.ap.c = np.zeros(0)
+
+
+class FiniteProperties(HasTraits):
+
+    a = NumericalTrait(allow_nan=False)
+    b = NumericalTrait(allow_inf=False)
+    c = NumericalTrait(domain='positive', allow_nan=False, allow_inf=False)
+
+
+class TestNonFinite(object):
+
+    def setup_method(self, method):
+        self.fp = FiniteProperties()
+
+    def test_scalar(self):
+        self.fp.a = np.inf
+        self.fp.b = np.nan
+        with pytest.raises(TraitError) as exc:
+            self.fp.a = np.nan
+        assert exc.value.args[0] == "a should not be NaN"
+        with pytest.raises(TraitError) as exc:
+            self.fp.b = -np.inf
+        assert exc.value.args[0] == "b should not be infinite"
+        with pytest.raises(TraitError) as exc:
+            self.fp.c = np.float32(np.nan)
+        assert exc.value.args[0] == "c should not be NaN"
+        with pytest.raises(TraitError) as exc:
+            self.fp.c = np.array(np.inf)
+        assert exc.value.args[0] == "All values of c should not be infinite"
+
+    def test_array(self):
+        self.fp.a = np.array([1., np.inf])
+        self.fp.b = np.array([1., np.nan])
+        self.fp.c = np.arange(10)
+        values = np.ones(300000)
+        values[200000] = np.nan
+        with pytest.raises(TraitError) as exc:
+            self.fp.a = values
+        assert exc.value.args[0] == "All values of a should not be NaN"
+        with pytest.raises(TraitError) as exc:
+            self.fp.c = values
+        assert exc.value.args[0] == "All values of c should not be NaN"
+        values[200000] = np.inf
+        with pytest.raises(TraitError) as exc:
+            self.fp.b = values
+        assert exc.value.args[0] == "All values of b should not be infinite"
+        values[200000] = -1
+        with pytest.raises(TraitError) as exc:
+            self.fp.c = values
+        assert exc.value.args[0] == "All values of c should be positive"
+
+    def test_validate_many(self):
+        values = np.ones((4, 3))
+        values[1, 0] = np.nan
+        values[2, 2] = np.inf
+        values[3, 1] = -1
+        with pytest.raises(MultipleTraitErrors) as exc:
+            FiniteProperties.c.validate_many(values)
+        assert exc.value.errors == {1: "All values of c should not be NaN",
+                                    2: "All values of c should not be infinite",
+                                    3: "All values of c should be positive"}
+
+    def test_bounds_violation(self):
+        values = np.array([1., np.nan, -np.inf])
+        assert _bounds_violation(values, 0.) == 'range'
+        assert _bounds_violation(values, allow_nan=False) == 'nan'
+        assert _bounds_violation(values, allow_inf=False) == 'inf'
+        assert _bounds_violation(values[:1], 0., allow_nan=False, allow_inf=False) is None
+
+    def test_complex(self):
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(dtype=complex, allow_nan=False)
+        assert exc.value.args[0] == "allow_nan and allow_inf cannot be used with dtype=complex128"
+
+
+class ConstrainedProperties(HasTraits):
+
+    positions = NumericalTrait(ndim=2, constraints=[Range([0., 0., -1.], [1., 1., 1.])])
+    grid = NumericalTrait(ndim=1, constraints=[Monotonic(strict=True)])
+    fractions = NumericalTrait(ndim=2, constraints=[Range(0., 1.), SumsTo(1., axis=1)])
+
+
+class TestConstraints(object):
+
+    def setup_method(self, method):
+        self.cp = ConstrainedProperties()
+
+    def test_range(self):
+        positions = np.zeros((100000, 3))
+        positions[:, 2] = -1.
+        self.cp.positions = positions
+        positions[99999, 2] = -1.5
+        with pytest.raises(TraitError) as exc:
+            self.cp.positions = positions
+        assert exc.value.args[0] == "All values of positions should be in the range [[0.0, 0.0, -1.0]:[1.0, 1.0, 1.0]]"
+
+    def test_monotonic(self):
+        grid = np.arange(200000.)
+        self.cp.grid = grid
+        # Check that the overlap between blocks is taken into account
+        grid[65536] = grid[65535]
+        with pytest.raises(TraitError) as exc:
+            self.cp.grid = grid
+        assert exc.value.args[0] == "grid should be strictly increasing along axis -1"
+        self.cp.grid = [3.]
+
+    def test_sums_to(self):
+        fractions = np.full((100000, 4), 0.25)
+        self.cp.fractions = fractions
+        fractions[50000] = [0.5, 0.5, 0.5, 0.]
+        with pytest.raises(TraitError) as exc:
+            self.cp.fractions = fractions
+        assert exc.value.args[0] == "fractions should sum to 1 along axis 1"
+        fractions[50000] = [1.5, -0.5, 0., 0.]
+        with pytest.raises(TraitError) as exc:
+            self.cp.fractions = fractions
+        assert exc.value.args[0] == "All values of fractions should be in the range [0:1]"
+
+    def test_validate_many(self):
+        grids = np.arange(12.).reshape(3, 4)
+        grids[1, 2] = 0.
+        with pytest.raises(MultipleTraitErrors) as exc:
+            ConstrainedProperties.grid.validate_many(grids)
+        assert exc.value.errors == {1: "grid should be strictly increasing along axis -1"}
+
+    def test_invalid(self):
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(constraints=['positive'])
+        assert exc.value.args[0] == "constraints should be a list of Constraint instances"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(constraints=Range(0, 1))
+        assert exc.value.args[0] == "constraints should be a list of Constraint instances"
+
+    def test_incompatible_trait(self):
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(ndim=1, constraints=[Monotonic(axis=1)])
+        assert exc.value.args[0] == "Monotonic with axis=1 cannot be used with ndim=1"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(ndim=2, constraints=[SumsTo(axis=-3)])
+        assert exc.value.args[0] == "SumsTo with axis=-3 cannot be used with ndim=2"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(ndim=1, constraints=[Range([[0, 0]])])
+        assert exc.value.args[0] == "Range bounds with shape (1, 2) cannot be used with ndim=1"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(shape=(5, 4), constraints=[Range([0, 0, 0])])
+        assert exc.value.args[0] == "Range bounds with shape (3,) cannot be used with shape=(5, 4)"
+
+    def test_incompatible_values(self):
+        trait = NumericalTrait(ndim=2, constraints=[Range([0, 0, 0], [1, 1, 1])])
+        trait.name = 'a'
+        with pytest.raises(TraitError) as exc:
+            trait.validate(None, np.zeros((5, 4)))
+        assert exc.value.args[0].startswith("Could not check the constraints of a (Exception:")
+        trait = NumericalTrait(constraints=[Monotonic(axis=1)])
+        trait.name = 'b'
+        with pytest.raises(TraitError) as exc:
+            trait.validate(None, np.zeros(3))
+        assert exc.value.args[0].startswith("Could not check the constraints of b (Exception:")
+        with pytest.raises(MultipleTraitErrors) as exc:
+            trait.validate_many(np.zeros((2, 3)))
+        assert sorted(exc.value.errors) == [0, 1]
+
+    def test_empty_axis(self):
+        trait = NumericalTrait(ndim=2, constraints=[SumsTo(axis=1)])
+        trait.name = 'a'
+        with pytest.raises(TraitError) as exc:
+            trait.validate(None, np.zeros((3, 0)))
+        assert exc.value.args[0] == "a should sum to 1 along axis 1"
+        trait = NumericalTrait(ndim=2, constraints=[SumsTo(0., axis=1)])
+        trait.name = 'a'
+        trait.validate(None, np.zeros((3, 0)))
+
+
+def test_shared_specs():
+
+    a = NumericalTrait(ndim=1, domain='positive')
+    b = NumericalTrait(ndim=1, domain='positive')
+    c = NumericalTrait(ndim=1, domain=[0, 1])
+    d = NumericalTrait(ndim=1, domain=(0., 1.))
+
+    assert a._spec is b._spec
+    assert a._spec is not c._spec
+    assert c.domain == [0, 1]
+    assert d.domain == (0., 1.)
+    assert not hasattr(a._spec, '__dict__')
+
+    # Changing the arguments of a trait does not change other traits
+    a.domain = 'negative'
+    assert a._spec is not b._spec
+    assert b.domain == 'positive'
+    b.validate(None, np.ones(3))
+    with pytest.raises(TraitError):
+        a.validate(None, np.ones(3))
+
+    # Arguments that cannot be hashed are not shared
+    e = NumericalTrait(default=np.ones(3))
+    f = NumericalTrait(default=np.ones(3))
+    assert e._spec is not f._spec
+
+
+def test_import_does_not_import_unit_frameworks():
+
+    # Importing numtraits should not import any of the unit frameworks, since
+    # these can be slow to import, nor any other modules that are only needed
+    # by some of the features (such as multiprocessing).
+    code = ("import sys; import numpy, traitlets; modules = set(sys.modules); "
+            "import numtraits; print(' '.join(sorted(set(sys.modules) - modules)))")
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.decode('ascii').split() == ['numtraits']
+
+
+def test_has_unit_framework():
+
+    import numtraits
+
+    for name, package in (('HAS_ASTROPY', 'astropy'),
+                          ('HAS_PINT', 'pint'),
+                          ('HAS_QUANTITIES', 'quantities')):
+        try:
+            __import__(package)
+        except ImportError:
+            assert getattr(numtraits, name) is False
+        else:
+            assert getattr(numtraits, name) is True
+
+
+class TestValidateMany(object):
+
+    def test_scalars(self):
+        values = np.array([1., -2., 3., -4.])
+        assert ScalarProperties.a.validate_many(values) is values
+        with pytest.raises(MultipleTraitErrors) as exc:
+            ScalarProperties.c.validate_many(values)
+        assert exc.value.errors == {1: "c should be strictly positive",
+                                    3: "c should be strictly positive"}
+        assert exc.value.args[0] == ("2 values failed validation:\n"
+                                     "  [1] c should be strictly positive\n"
+                                     "  [3] c should be strictly positive")
+
+    @pytest.mark.parametrize('trait', [ScalarProperties.a, ScalarProperties.b, FiniteProperties.a])
+    def test_strings(self, trait):
+        # Strings are rejected as they are when validating values one at a time
+        values = ['1', 2., b'3', np.str_('-4'), np.float32(5.)]
+        errors = {}
+        for index, value in enumerate(values):
+            try:
+                trait.validate(None, value)
+            except TraitError as exc:
+                errors[index] = exc.args[0]
+        assert sorted(errors) == [0, 2, 3]
+        with pytest.raises(MultipleTraitErrors) as exc:
+            trait.validate_many(values)
+        assert exc.value.errors == errors
+
+    def test_arrays(self):
+        values = np.ones((5, 3))
+        values[2, 1] = -1.
+        ArrayProperties.a.validate_many(values)
+        with pytest.raises(MultipleTraitErrors) as exc:
+            ArrayProperties.b.validate_many(values)
+        assert exc.value.errors == {2: "All values of b should be positive"}
+
+    def test_shape(self):
+        with pytest.raises(MultipleTraitErrors) as exc:
+            ArrayProperties.a.validate_many(np.ones((2, 4)))
+        assert exc.value.errors == {0: "a has incorrect length (expected 3 but found 4)",
+                                    1: "a has incorrect length (expected 3 but found 4)"}
+
+    def test_list(self):
+        validated = ArrayProperties.f.validate_many([(3., 4.), [3.5], np.array([3.2])])
+        np.testing.assert_allclose(validated[0], (3., 4.))
+        assert isinstance(validated[0], np.ndarray)
+        validated = ScalarProperties.f.validate_many([3., 3.5, 4.])
+        assert validated == [3., 3.5, 4.]
+        with pytest.raises(MultipleTraitErrors) as exc:
+            ScalarProperties.f.validate_many([3., 5., 3.5, 'a'])
+        assert exc.value.errors == {1: "f should be in the range [3:4]",
+                                    3: "f should be a numerical value"}
+
+    def test_dtype(self):
+        trait = NumericalTrait(ndim=1, dtype=np.int16)
+        trait.name = 'a'
+        validated = trait.validate_many([[1, 2], [3, 4]])
+        np.testing.assert_equal(validated, [[1, 2], [3, 4]])
+        trait = NumericalTrait(ndim=1, dtype=np.int16, cast=True)
+        trait.name = 'a'
+        assert trait.validate_many([[1, 2], [3, 4]])[1].dtype == np.int16
+        trait = NumericalTrait(ndim=0, dtype=np.int16, casting='safe')
+        trait.name = 'a'
+        assert trait.validate_many([1, 2, np.int16(3)]) == [1, 2, 3]
+        with pytest.raises(MultipleTraitErrors) as exc:
+            trait.validate_many([1, 100000, 2.5])
+        assert exc.value.errors == {1: "a should have a dtype that can be cast to int16 with 'safe' casting (found int)",
+                                    2: "a should have a dtype that can be cast to int16 with 'safe' casting (found float)"}
+
+    def test_empty(self):
+        assert ScalarProperties.b.validate_many([]) == []
+
+
+class TestConversion(object):
+
+    def test_native_dtype(self):
+        ap = ArrayProperties()
+        for dtype in (np.int32, np.float32, np.int64):
+            values = np.arange(1, 4, dtype=dtype)
+            ap.c = values
+            assert ap.c is values
+        with pytest.raises(TraitError) as exc:
+            ap.c = np.arange(3, dtype=np.int16)
+        assert exc.value.args[0] == "All values of c should be strictly positive"
+
+    def test_buffer(self):
+        ap = ArrayProperties()
+        values = np.arange(1., 4., dtype=np.float32)
+        ap.a = memoryview(values)
+        assert isinstance(ap.a, np.ndarray)
+        assert ap.a.dtype == np.float32
+        assert np.shares_memory(ap.a, values)
+        with pytest.raises(TraitError) as exc:
+            ap.b = memoryview(-values)
+        assert exc.value.args[0] == "All values of b should be positive"
+
+    def test_never_copy(self):
+
+        class Properties(HasTraits):
+            a = NumericalTrait(ndim=1, conversion='never-copy')
+
+        p = Properties()
+        values = np.ones(3, dtype=np.float32)
+        p.a = values
+        assert p.a is values
+        with pytest.raises(TraitError) as exc:
+            p.a = [1., 2., 3.]
+        assert exc.value.args[0] == "a could not be converted to a Numpy array without copying"
+
+    def test_always_copy(self):
+
+        class Properties(HasTraits):
+            a = NumericalTrait(ndim=1, domain='positive', conversion='always-copy')
+
+        p = Properties()
+        values = np.ones(3)
+        p.a = values
+        assert not np.shares_memory(p.a, values)
+        values[0] = -1.
+        assert p.a[0] == 1.
+
+    def test_invalid_policy(self):
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(conversion='maybe-copy')
+        assert exc.value.args[0] == "conversion should be one of 'never-copy', 'copy-if-needed', 'always-copy'"
+
+
+class DtypeProperties(HasTraits):
+
+    a = NumericalTrait(ndim=1, dtype=np.float32)
+    b = NumericalTrait(ndim=1, dtype=np.float32, cast=True, domain='positive')
+    c = NumericalTrait(ndim=1, dtype=np.int16, casting='safe')
+    d = NumericalTrait(ndim=0, dtype=complex)
+    e = NumericalTrait(ndim=0, dtype=np.float32, cast=True)
+
+
+class TestDtype(object):
+
+    def setup_method(self, method):
+
+        self.dp = DtypeProperties()
+
+    def test_preserved(self):
+        values = np.ones(3, dtype=np.float32)
+        self.dp.a = values
+        assert self.dp.a is values
+        values = np.ones(3, dtype=np.float64)
+        self.dp.a = values
+        assert self.dp.a is values
+
+    def test_cast(self):
+        self.dp.b = np.ones(3, dtype=np.float64)
+        assert self.dp.b.dtype == np.float32
+        self.dp.b = [1, 2, 3]
+        assert self.dp.b.dtype == np.float32
+        self.dp.e = 3
+        assert type(self.dp.e) is np.float32
+        with pytest.raises(TraitError) as exc:
+            self.dp.b = np.array([1., -1.])
+        assert exc.value.args[0] == "All values of b should be positive"
+
+    @pytest.mark.parametrize('values', [1e-50, [1., 1e-50]])
+    def test_cast_underflow(self, values):
+        # Values that are cast to zero are not strictly positive
+
+        class Properties(HasTraits):
+            a = NumericalTrait(dtype=np.float32, cast=True, domain='strictly-positive')
+
+        p = Properties()
+        with pytest.raises(TraitError) as exc:
+            p.a = values
+        assert exc.value.args[0].endswith("a should be strictly positive")
+        with pytest.raises(MultipleTraitErrors) as exc:
+            Properties.a.validate_many([values])
+        with pytest.raises(MultipleTraitErrors) as exc:
+            Properties.a.validate_many(np.array([values]))
+
+    @pytest.mark.parametrize('values', [40000, np.int32(40000), np.array([1, 40000])])
+    def test_cast_wraparound(self, values):
+        # Integers that are out of range for the dtype wrap around when cast
+
+        class Properties(HasTraits):
+            a = NumericalTrait(dtype=np.int16, casting='unsafe', cast=True, domain='positive')
+
+        p = Properties()
+        with pytest.raises(TraitError):
+            p.a = values
+        with pytest.raises(MultipleTraitErrors) as exc:
+            Properties.a.validate_many([values])
+        assert list(exc.value.errors) == [0]
+
+    def test_cast_overflow(self):
+        # Values that overflow when cast become infinite
+
+        class Properties(HasTraits):
+            a = NumericalTrait(dtype=np.float32, cast=True, allow_inf=False)
+            b = NumericalTrait(dtype=np.int32, casting='unsafe', cast=True, allow_nan=False)
+
+        p = Properties()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            with pytest.raises(TraitError) as exc:
+                p.a = 1e300
+            assert exc.value.args[0] == "a should not be infinite"
+            with pytest.raises(TraitError) as exc:
+                p.a = np.array([1., 1e300])
+            assert exc.value.args[0] == "All values of a should not be infinite"
+            with pytest.raises(MultipleTraitErrors) as exc:
+                Properties.a.validate_many([1., 1e300])
+            assert exc.value.errors == {1: "a should not be infinite"}
+            # NaN values cannot be represented by integers, so are rejected
+            # before casting
+            with pytest.raises(TraitError) as exc:
+                p.b = np.array([1., np.nan])
+            assert exc.value.args[0] == "All values of b should not be NaN"
+            with pytest.raises(MultipleTraitErrors) as exc:
+                Properties.b.validate_many([1., np.nan])
+            assert exc.value.errors == {1: "b should not be NaN"}
+        p.a = 1e30
+        assert p.a == np.float32(1e30)
+
+    def test_casting(self):
+        self.dp.c = np.ones(3, dtype=np.int8)
+        self.dp.c = np.array([1, 2, 3], dtype=np.uint8)
+        with pytest.raises(TraitError) as exc:
+            self.dp.c = np.ones(3, dtype=np.int32)
+        assert exc.value.args[0] == "c should have a dtype that can be cast to int16 with 'safe' casting (found int32)"
+        with pytest.raises(TraitError) as exc:
+            self.dp.a = np.ones(3, dtype=complex)
+        assert exc.value.args[0] == "a should have a dtype that can be cast to float32 with 'same_kind' casting (found complex128)"
+
+    def test_complex(self):
+        self.dp.d = 1 + 2j
+        assert self.dp.d == 1 + 2j
+        with pytest.raises(TraitError) as exc:
+            self.dp.d = 'a'
+        assert exc.value.args[0] == "d should be a numerical value"
+
+    def test_invalid_args(self):
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(dtype='spam')
+        assert exc.value.args[0] == "dtype='spam' is not a valid Numpy dtype"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(dtype=str)
+        assert exc.value.args[0] == "dtype=<U0 is not a numerical dtype"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(dtype=complex, domain='positive')
+        assert exc.value.args[0] == "domain cannot be used with dtype=complex128"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(casting='maybe')
+        assert exc.value.args[0] == "casting should be one of 'no', 'equiv', 'safe', 'same_kind', 'unsafe'"
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(cast=True)
+        assert exc.value.args[0] == "dtype should be specified if cast=True"
+
+
+class ChunkedArray(object):
+    """
+    A minimal chunked array-like object, similar to h5py Datasets, which keeps
+    track of the largest number of elements read at once.
+    """
+
+    def __init__(self, array, chunks):
+        self._array = array
+        self.chunks = chunks
+        self.shape = array.shape
+        self.ndim = array.ndim
+        self.dtype = array.dtype
+        self.max_read = 0
+
+    def __getitem__(self, item):
+        values = self._array[item]
+        self.max_read = max(self.max_read, np.size(values))
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        raise AssertionError("the whole array should not be read")
+
+
+class TestOutOfCore(object):
+
+    def setup_method(self, method):
+
+        self.ap = ArrayProperties()
+
+    def test_chunked(self):
+        array = ChunkedArray(np.ones((3000, 1000)), chunks=(100, 1000))
+        self.ap.b = ChunkedArray(np.ones(10), chunks=(5,))
+        with pytest.raises(TraitError) as exc:
+            self.ap.b = array
+        assert exc.value.args[0] == "b should be a 1-d sequence"
+        self.ap.a = ChunkedArray(np.ones(3), chunks=(3,))
+        with pytest.raises(TraitError) as exc:
+            self.ap.a = ChunkedArray(np.ones(4), chunks=(3,))
+        assert exc.value.args[0] == "a has incorrect length (expected 3 but found 4)"
+
+    def test_chunked_domain(self):
+
+        class Properties(HasTraits):
+            a = NumericalTrait(ndim=2, domain='positive')
+
+        p = Properties()
+        values = np.ones((3000, 1000))
+        array = ChunkedArray(values, chunks=(100, 1000))
+        p.a = array
+        assert p.a is array
+        assert array.max_read <= 2 ** 20
+        values[-1, -1] = -1
+        with pytest.raises(TraitError) as exc:
+            p.a = array
+        assert exc.value.args[0] == "All values of a should be positive"
+
+    def test_memmap(self, tmpdir):
+        filename = tmpdir.join('values.dat').strpath
+        values = np.memmap(filename, dtype=np.float32, mode='w+', shape=(1000, 300))
+        values[...] = 1.
+        values[999, 299] = -1.
+        with pytest.raises(TraitError) as exc:
+            self.ap.b = values.ravel()
+        assert exc.value.args[0] == "All values of b should be positive"
+        self.ap.b = values[:999].ravel()
+        assert isinstance(self.ap.b, np.memmap)
+
+
+class StreamProperties(HasTraits):
+
+    values = NumericalTrait(ndim=1, domain='positive')
+    fixed = NumericalTrait(shape=(4,), domain=(0., 10.))
+    rows = NumericalTrait(shape=(3, 2), domain='positive')
+    sums = NumericalTrait(ndim=1, constraints=[Monotonic()])
+
+
+class TestStreaming(object):
+
+    def setup_method(self, method):
+        self.sp = StreamProperties()
+
+    def test_generator(self):
+        self.sp.values = (x ** 2 for x in range(5))
+        np.testing.assert_equal(self.sp.values, [0., 1., 4., 9., 16.])
+        self.sp.values = iter([])
+        assert self.sp.values.shape == (0,)
+        self.sp.fixed = map(float, '1234')
+        np.testing.assert_equal(self.sp.fixed, [1., 2., 3., 4.])
+        self.sp.rows = ((x, x + 1) for x in range(3))
+        np.testing.assert_equal(self.sp.rows, [[0., 1.], [1., 2.], [2., 3.]])
+
+    def test_fail_fast(self):
+        read = []
+
+        def values():
+            for x in range(10 ** 6):
+                read.append(x)
+                yield -1. if x == 10 else 1.
+
+        with pytest.raises(TraitError) as exc:
+            self.sp.values = values()
+        assert exc.value.args[0] == "All values of values should be positive"
+        assert len(read) < 10 ** 6
+
+    def test_incorrect_length(self):
+        with pytest.raises(TraitError) as exc:
+            self.sp.fixed = iter([1., 2., 3.])
+        assert exc.value.args[0] == "fixed has incorrect length (expected 4 but found 3)"
+        with pytest.raises(TraitError) as exc:
+            self.sp.fixed = iter([1., 2., 3., 4., 5.])
+        assert exc.value.args[0] == "fixed has incorrect length (expected 4 but found more)"
+        with pytest.raises(TraitError) as exc:
+            self.sp.rows = iter([(1., 2.)])
+        assert exc.value.args[0] == "rows has incorrect shape (expected (3, 2) but found 1 rows)"
+
+    def test_invalid_items(self):
+        with pytest.raises(TraitError) as exc:
+            self.sp.rows = iter([(1., 2., 3.)] * 3)
+        assert exc.value.args[0].startswith("Could not convert value of rows to a Numpy array")
+        with pytest.raises(TraitError) as exc:
+            self.sp.values = iter(['a'])
+        assert exc.value.args[0].startswith("Could not convert value of values to a Numpy array")
+
+    def test_constraints(self):
+        self.sp.sums = iter([1., 2., 3.])
+        with pytest.raises(TraitError) as exc:
+            self.sp.sums = iter([1., 3., 2.])
+        assert exc.value.args[0] == "sums should be increasing along axis -1"
+
+    def test_dtype(self):
+        trait = NumericalTrait(ndim=1, dtype=np.int16, domain='positive')
+        trait.name = 'a'
+        np.testing.assert_equal(trait.validate(None, (x for x in range(3))), [0, 1, 2])
+        with pytest.raises(TraitError) as exc:
+            trait.validate(None, (x - 1 for x in range(3)))
+        assert exc.value.args[0] == "All values of a should be positive"
+        with pytest.raises(TraitError) as exc:
+            trait.validate(None, (x / 2 for x in range(3)))
+        assert exc.value.args[0] == "a should have a dtype that can be cast to int16 with 'same_kind' casting (found float64)"
+        trait = NumericalTrait(shape=(2,), dtype=complex)
+        trait.name = 'b'
+        assert trait.validate(None, (x * 1j for x in range(2)))[1] == 1j
+        with pytest.raises(TraitError) as exc:
+            trait.validate(None, iter([1j]))
+        assert exc.value.args[0] == "b has incorrect length (expected 2 but found 1)"
+
+    def test_never_copy(self):
+        trait = NumericalTrait(ndim=1, conversion='never-copy')
+        trait.name = 'a'
+        with pytest.raises(TraitError) as exc:
+            trait.validate(None, iter([1., 2.]))
+        assert exc.value.args[0] == "a could not be converted to a Numpy array without copying"
+
+
+class UpdateProperties(HasTraits):
+
+    grid = NumericalTrait(ndim=1, domain='positive', validate_updates=True)
+    counts = NumericalTrait(ndim=2, dtype=np.int32, cast=True, validate_updates=True)
+    sorted = NumericalTrait(ndim=1, constraints=[Monotonic()], validate_updates=True)
+
+
+class TestValidateUpdates(object):
+
+    def setup_method(self, method):
+        self.up = UpdateProperties()
+        self.up.grid = np.ones(1000)
+
+    def test_stored(self):
+        values = np.ones(10)
+        self.up.grid = values
+        assert type(self.up.grid) is ValidatedArray
+        assert np.shares_memory(self.up.grid, values)
+        grid = self.up.grid
+        self.up.grid = grid
+        assert self.up.grid is grid
+
+    @pytest.mark.parametrize('update', ["grid[3] = -1",
+                                        "grid[10:20] = [1.] * 9 + [-1.]",
+                                        "grid[2:8][1:3] = -4",
+                                        "grid.fill(-1)",
+                                        "grid -= 2",
+                                        "np.subtract(grid, 3, out=grid)",
+                                        "np.negative.at(grid, [5])"])
+    def test_invalid_update(self, update):
+        grid = self.up.grid
+        with pytest.raises(TraitError) as exc:
+            exec(update, {'np': np, 'grid': grid})
+        assert exc.value.args[0] == "All values of grid should be positive"
+        np.testing.assert_equal(grid, 1.)
+
+    def test_valid_update(self):
+        grid = self.up.grid
+        grid[10:20] = 3.
+        grid[2:8][1:3] = 4.
+        grid += 1
+        np.multiply(grid, 2, out=grid)
+        assert self.up.grid is grid
+        assert grid[10] == 8. and grid[4] == 10. and grid[0] == 4.
+
+    def test_copies_not_checked(self):
+        grid = self.up.grid
+        copy = grid.copy()
+        copy[0] = -1
+        result = grid - 2
+        assert type(result) is np.ndarray
+        assert np.all(grid == 1.)
+
+    def test_dtype(self):
+        self.up.counts = np.ones((3, 3), dtype=np.int16)
+        counts = self.up.counts
+        assert counts.dtype == np.int32
+        counts[0] = [1, 2, 3]
+        with pytest.raises(TraitError) as exc:
+            counts[1, 1] = 2.5
+        assert exc.value.args[0] == "counts should have a dtype that can be cast to int32 with 'same_kind' casting (found float)"
+        assert counts[1, 1] == 1
+
+    def test_python_numbers(self):
+        trait = NumericalTrait(ndim=1, dtype=np.int16, casting='safe', validate_updates=True)
+        trait.name = 'd'
+        values = trait.validate(None, np.zeros(4, dtype=np.int16))
+        values[0] = 5
+        values[1:3] = [6, 7]
+        np.testing.assert_equal(values, [5, 6, 7, 0])
+        for update in (100000, [1, 100000], np.int64(3)):
+            with pytest.raises(TraitError):
+                values[0:1] = update
+        with pytest.raises(TraitError) as exc:
+            values[0] = 2.5
+        assert exc.value.args[0] == "d should have a dtype that can be cast to int16 with 'safe' casting (found float)"
+        np.testing.assert_equal(values, [5, 6, 7, 0])
+
+    def test_constraints(self):
+        self.up.sorted = np.arange(10.)
+        values = self.up.sorted
+        values[9] = 100.
+        with pytest.raises(TraitError) as exc:
+            values[3:5] = [10., 11.]
+        assert exc.value.args[0] == "sorted should be increasing along axis -1"
+        np.testing.assert_equal(values[:9], np.arange(9.))
+
+    def test_assign_validated(self):
+        obj = UpdateProperties()
+        assign_validated(obj, {'grid': np.ones(3)})
+        assert type(obj.grid) is ValidatedArray
+        with pytest.raises(TraitError):
+            obj.grid[0] = -1
+
+    def test_units(self):
+        u = pytest.importorskip('astropy.units')
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(convertible_to=u.m, validate_updates=True)
+        assert exc.value.args[0] == "validate_updates cannot be used with convertible_to"
+
+
+class ReadonlyProperties(HasTraits):
+
+    values = NumericalTrait(ndim=1, domain='positive', readonly=True)
+    owned = NumericalTrait(ndim=1, domain='positive', readonly=True, conversion='always-copy')
+    cached = NumericalTrait(ndim=1, readonly=True, cache=True)
+
+
+class TestReadonly(object):
+
+    def setup_method(self, method):
+        self.rp = ReadonlyProperties()
+
+    def test_readonly(self):
+        values = np.ones(10)
+        self.rp.values = values
+        assert not self.rp.values.flags.writeable
+        assert np.shares_memory(self.rp.values, values)
+        assert values.flags.writeable
+        with pytest.raises(ValueError):
+            self.rp.values[0] = -1
+        self.rp.values = [1., 2.]
+        assert not self.rp.values.flags.writeable
+
+    def test_readonly_input(self):
+        values = np.ones(10)
+        values.flags.writeable = False
+        self.rp.values = values
+        assert self.rp.values is values
+
+    def test_owned(self):
+        values = np.ones(10)
+        self.rp.owned = values
+        assert not self.rp.owned.flags.writeable
+        assert not np.shares_memory(self.rp.owned, values)
+
+    def test_cached(self):
+        values = np.ones(10)
+        self.rp.cached = values
+        stored = self.rp.cached
+        self.rp.cached = values
+        # Each assignment gives a new read-only view of the cached array
+        assert self.rp.cached is not stored
+        assert not self.rp.cached.flags.writeable
+        assert self.rp.cached.base is values
+
+    def test_quantity(self):
+        u = pytest.importorskip('astropy.units')
+        trait = NumericalTrait(convertible_to=u.m, readonly=True)
+        trait.name = 'a'
+        value = trait.validate(None, np.ones(3) * u.km)
+        assert value.unit == u.km
+        assert not value.flags.writeable
+
+    def test_assign_validated(self):
+        assign_validated(self.rp, {'values': np.ones(3)})
+        assert not self.rp.values.flags.writeable
+
+    def test_validate_many(self):
+        validated = ReadonlyProperties.values.validate_many([[1., 2.], np.ones(3)])
+        assert not any(value.flags.writeable for value in validated)
+        values = np.ones((4, 3))
+        validated = ReadonlyProperties.values.validate_many(values)
+        assert not validated.flags.writeable
+        assert np.shares_memory(validated, values)
+        validated = UpdateProperties.grid.validate_many([np.ones(3)])
+        assert type(validated[0]) is ValidatedArray
+        with pytest.raises(TraitError):
+            validated[0][0] = -1.
+
+    def test_validate_updates(self):
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(ndim=1, readonly=True, validate_updates=True)
+        assert exc.value.args[0] == "validate_updates and readonly cannot be used together"
+
+
+class SharedProperties(HasTraits):
+
+    grid = NumericalTrait(ndim=2, domain='positive', shared=True)
+    frozen = NumericalTrait(ndim=1, shared=True, readonly=True)
+
+
+def _update_shared(obj):
+    obj.grid[0, 0] = 42.
+    return type(obj.grid).__name__, obj.grid.metadata
+
+
+class TestShared(object):
+
+    def setup_method(self, method):
+        self.sp = SharedProperties()
+        self.sp.grid = np.ones((100, 100))
+
+    def test_shared(self):
+        grid = self.sp.grid
+        assert type(grid) is SharedArray
+        np.testing.assert_equal(grid, 1.)
+        assert grid.metadata == {'name': 'grid', 'ndim': 2, 'shape': None,
+                                 'dtype': None, 'domain': 'positive'}
+        assert type(grid.sum()) is np.float64
+        self.sp.grid = grid
+        assert self.sp.grid is grid
+
+    def test_small(self):
+        self.sp.grid = np.ones((3, 3))
+        assert type(self.sp.grid) is np.ndarray
+
+    def test_pickle(self):
+        grid = self.sp.grid
+        data = pickle.dumps(self.sp)
+        assert len(data) < 1000
+        sp = pickle.loads(data)
+        assert type(sp.grid) is SharedArray
+        assert np.shares_memory(sp.grid, grid)
+        view = pickle.loads(pickle.dumps(grid[::-3, 5::7]))
+        assert np.shares_memory(view, grid)
+        np.testing.assert_equal(view, grid[::-3, 5::7])
+        copy = pickle.loads(pickle.dumps(grid.copy()))
+        assert not np.shares_memory(copy, grid)
+
+    def test_processes(self):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            name, metadata = executor.submit(_update_shared, self.sp).result()
+        assert name == 'SharedArray'
+        assert metadata['domain'] == 'positive'
+        assert self.sp.grid[0, 0] == 42.
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_validate_records(self, processes):
+        records = [{'grid': np.full((100, 100), i + 1.)} for i in range(3)]
+        results = validate_records(SharedProperties, records, processes=processes)
+        assert type(results[2]['grid']) is np.ndarray
+        assign_validated(self.sp, results[2])
+        assert type(self.sp.grid) is SharedArray
+        np.testing.assert_equal(self.sp.grid, 3.)
+
+    def test_released(self):
+        from multiprocessing import shared_memory
+        name = self.sp.grid._shm.name
+        self.sp.grid = np.ones((100, 100))
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+    def test_readonly(self):
+        self.sp.frozen = np.ones(100000)
+        assert type(self.sp.frozen) is SharedArray
+        frozen = pickle.loads(pickle.dumps(self.sp.frozen))
+        assert not frozen.flags.writeable
+        assert np.shares_memory(frozen, self.sp.frozen)
+
+    def test_validate_updates(self):
+        with pytest.raises(TraitError) as exc:
+            NumericalTrait(ndim=1, shared=True, validate_updates=True)
+        assert exc.value.args[0] == "validate_updates and shared cannot be used together"
+
+
+class SnapshotModel(HasTraits):
+
+    grid = NumericalTrait(ndim=2, domain='positive')
+    times = NumericalTrait(ndim=1, constraints=[Monotonic()])
+    radius = NumericalTrait(ndim=0, domain='positive')
+    count = NumericalTrait(ndim=0, dtype=np.int32)
+    name = Unicode()
+
+
+def _strict_snapshot_model():
+    # SnapshotModel with stricter options, as if the class had changed since
+    # a snapshot was saved.
+
+    class SnapshotModel(HasTraits):
+
+        grid = NumericalTrait(ndim=2, domain=(0., 1.))
+        times = NumericalTrait(ndim=1, constraints=[Monotonic(strict=True)])
+        radius = NumericalTrait(ndim=0, domain='positive')
+        count = NumericalTrait(ndim=0, dtype=np.int32)
+
+    return SnapshotModel
+
+
+class TestSnapshot(object):
+
+    def setup_method(self, method):
+        self.model = SnapshotModel()
+        self.model.grid = np.arange(1., 13.).reshape(3, 4)
+        self.model.times = [0., 1., 1., 2.]
+        self.model.radius = 2.5
+        self.model.count = np.int32(3)
+
+    def _counting(self, monkeypatch):
+        validated = []
+        validate_value = NumericalTrait._validate_value
+        monkeypatch.setattr(NumericalTrait, '_validate_value',
+                            lambda trait, value, stats=None: validated.append(trait.name) or validate_value(trait, value, stats))
+        return validated
+
+    @pytest.mark.parametrize('mmap_mode', [None, 'r', 'c'])
+    def test_round_trip(self, tmp_path, monkeypatch, mmap_mode):
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        validated = self._counting(monkeypatch)
+        model = SnapshotModel()
+        load_snapshot(filename, model, mmap_mode=mmap_mode)
+        assert validated == []
+        np.testing.assert_equal(model.grid, self.model.grid)
+        np.testing.assert_equal(model.times, self.model.times)
+        assert type(model.radius) is float and model.radius == 2.5
+        assert type(model.count) is np.int32 and model.count == 3
+        assert model.grid.flags.writeable == (mmap_mode != 'r')
+
+    def test_non_contiguous(self, tmp_path, monkeypatch):
+        monkeypatch.setattr('numtraits._OUT_OF_CORE_BLOCK_SIZE', 4)
+        values = np.arange(1., 41.).reshape(4, 10)
+        self.model.grid = values[::-1, ::3]
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        model = SnapshotModel()
+        load_snapshot(filename, model)
+        np.testing.assert_equal(model.grid, values[::-1, ::3])
+
+    def test_notifications(self, tmp_path):
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        model = SnapshotModel()
+        changes = []
+        model.observe(lambda change: changes.append((change.name, model.radius)), names=['grid', 'radius'])
+        load_snapshot(filename, model)
+        assert sorted(changes) == [('grid', 2.5), ('radius', 2.5)]
+
+    def test_revalidate(self, tmp_path, monkeypatch):
+        filename = str(tmp_path / 'models.snap')
+        save_snapshot(filename, [self.model, self.model])
+        validated = self._counting(monkeypatch)
+        model_class = _strict_snapshot_model()
+        models = [model_class(), model_class()]
+        with pytest.raises(MultipleTraitErrors) as exc:
+            load_snapshot(filename, models)
+        assert exc.value.errors == {(0, 'grid'): "All values of grid should be in the range [0:1]",
+                                    (0, 'times'): "times should be strictly increasing along axis -1",
+                                    (1, 'grid'): "All values of grid should be in the range [0:1]",
+                                    (1, 'times'): "times should be strictly increasing along axis -1"}
+        assert sorted(validated) == ['grid', 'grid', 'times', 'times']
+        assert 'radius' not in models[0]._trait_values
+
+    def test_checksum(self, tmp_path):
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        with open(filename, 'r+b') as f:
+            f.seek(64)
+            f.write(b'\x00')
+        with pytest.raises(TraitError) as exc:
+            load_snapshot(filename, SnapshotModel())
+        assert exc.value.args[0].startswith("The data for ")
+        assert exc.value.args[0].endswith(" does not match its checksum")
+        model = SnapshotModel()
+        load_snapshot(filename, model, verify=False)
+        assert model.radius == 2.5
+
+    def test_no_verify(self, tmp_path, monkeypatch):
+        # Without checksums, the data is validated
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        data = data.replace(np.float64(5.).tobytes(), np.float64(-5.).tobytes())
+        with open(filename, 'wb') as f:
+            f.write(data)
+        validated = self._counting(monkeypatch)
+        with pytest.raises(MultipleTraitErrors) as exc:
+            load_snapshot(filename, SnapshotModel(), verify=False)
+        assert exc.value.errors == {'grid': "All values of grid should be positive"}
+        # radius is a float, so it is validated without _validate_value
+        assert sorted(validated) == ['count', 'grid', 'times']
+
+    def test_class(self, tmp_path):
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        with pytest.raises(TraitError) as exc:
+            load_snapshot(filename, ArrayProperties())
+        assert exc.value.args[0] == "{0} was saved from an object of class SnapshotModel but an object of class ArrayProperties was given".format(filename)
+
+    def test_invalid(self, tmp_path):
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        with pytest.raises(TraitError) as exc:
+            load_snapshot(filename, [SnapshotModel(), SnapshotModel()])
+        assert exc.value.args[0] == "{0} contains 1 objects but 2 were given".format(filename)
+        with pytest.raises(TraitError) as exc:
+            load_snapshot(__file__, SnapshotModel())
+        assert exc.value.args[0] == "{0} is not a numtraits snapshot".format(__file__)
+
+    def test_units(self, tmp_path):
+        u = pytest.importorskip('astropy.units')
+
+        class UnitModel(HasTraits):
+            length = NumericalTrait(convertible_to=u.m)
+
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        model = UnitModel(length=3 * u.m)
+        with pytest.raises(TraitError) as exc:
+            save_snapshot(filename, [self.model, model])
+        assert exc.value.args[0] == "length cannot be saved in a snapshot (only numbers and Numpy arrays are supported)"
+        # The previous snapshot is left intact
+        assert os.listdir(str(tmp_path)) == ['model.snap']
+        model = SnapshotModel()
+        load_snapshot(filename, model)
+        assert model.radius == 2.5
+
+    @pytest.mark.parametrize('mmap_mode', [None, 'r'])
+    def test_corrupt(self, tmp_path, mmap_mode):
+        filename = str(tmp_path / 'model.snap')
+        save_snapshot(filename, self.model)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        corrupt = str(tmp_path / 'corrupt.snap')
+        for contents in (data[:-10], data[:100], data[:20], data[:-20] + b'x' * 20):
+            with open(corrupt, 'wb') as f:
+                f.write(contents)
+            with pytest.raises(TraitError) as exc:
+                load_snapshot(corrupt, SnapshotModel(), mmap_mode=mmap_mode)
+            assert exc.value.args[0] == "{0} is truncated or corrupt".format(corrupt)
+
+
+class TestDeferred(object):
+
+    def setup_method(self, method):
+
+        self.ap = ArrayProperties()
+
+    def test_deferred(self):
+        changes = []
+        self.ap.observe(changes.append, names=['a', 'b'])
+        with deferred(self.ap):
+            self.ap.a = (1, 2)
+            self.ap.a = (1, 2, 3)
+            self.ap.b = [-1, 2]
+            self.ap.b = [1, 2]
+            assert changes == []
+        assert isinstance(self.ap.a, np.ndarray)
+        assert [change.name for change in changes] == ['a', 'b']
+        assert changes[0].new is self.ap.a
+
+    def test_validated_once(self, monkeypatch):
+        validated = []
+        validate_value = NumericalTrait._validate_value
+        monkeypatch.setattr(NumericalTrait, '_validate_value',
+                            lambda trait, value, stats=None: validated.append(trait.name) or validate_value(trait, value, stats))
+        with deferred(self.ap):
+            self.ap.a = (1, 2, 3)
+        assert validated == ['a']
+        assign_validated(self.ap, {'a': np.array([4., 5., 6.])})
+        assert validated == ['a']
+        assert self.ap.a[0] == 4.
+
+    def test_observer_validated(self):
+
+        class Linked(HasTraits):
+            a = NumericalTrait(ndim=0)
+            b = NumericalTrait(ndim=0, domain='positive')
+
+            @observe('a')
+            def _a_changed(self, change):
+                self.b = -change.new
+
+        linked = Linked()
+        with pytest.raises(TraitError):
+            with deferred(linked):
+                linked.a = 3
+        assert 'b' not in linked._trait_values
+        with pytest.raises(TraitError):
+            assign_validated(linked, {'a': 4.})
+        assert 'b' not in linked._trait_values
+
+    def test_errors(self):
+        self.ap.a = (1, 2, 3)
+        a = self.ap.a
+        with pytest.raises(MultipleTraitErrors) as exc:
+            with deferred(self.ap):
+                self.ap.a = (1, 2)
+                self.ap.b = (1, 2)
+                self.ap.c = (-1, 2)
+        assert exc.value.errors == {'a': "a has incorrect length (expected 3 but found 2)",
+                                    'c': "All values of c should be strictly positive"}
+        assert self.ap.a is a
+        assert 'b' not in self.ap._trait_values
+        assert 'c' not in self.ap._trait_values
+
+    def test_exception(self):
+        self.ap.a = (1, 2, 3)
+        a = self.ap.a
+        with pytest.raises(ValueError):
+            with deferred(self.ap):
+                self.ap.a = (1, 2)
+                raise ValueError()
+        assert self.ap.a is a
+        self.ap.a = (4, 5, 6)
+
+
+@pytest.mark.parametrize('type', [int, float, np.int8, np.uint16, np.int64,
+                                  np.float16, np.float32, np.float64, np.longdouble])
+def test_scalar_types(type):
+    sp = ScalarProperties()
+    sp.b = type(3)
+    assert sp.b == 3
+    assert sp.b.__class__ is type
+    sp.f = type(3)
+    with pytest.raises(TraitError) as exc:
+        sp.c = type(0)
+    assert exc.value.args[0] == "c should be strictly positive"
+    with pytest.raises(TraitError) as exc:
+        sp.f = type(5)
+    assert exc.value.args[0] == "f should be in the range [3:4]"
+    with pytest.raises(TraitError) as exc:
+        ArrayProperties().b = type(5)
+    assert exc.value.args[0] == "b should be a 1-d sequence"
+
+
+def test_longdouble_precision():
+    if np.finfo(np.longdouble).eps >= np.finfo(np.float64).eps:
+        pytest.skip("long doubles have the same precision as doubles")
+    trait = NumericalTrait(ndim=0, domain=(0, 1))
+    trait.name = 'a'
+    value = np.longdouble(1) + np.finfo(np.longdouble).eps
+    assert float(value) == 1.
+    with pytest.raises(TraitError) as exc:
+        trait.validate(None, value)
+    assert exc.value.args[0] == "a should be in the range [0:1]"
+
+
+
+def test_scalar_bool():
+    sp = ScalarProperties()
+    sp.b = True
+    sp.b = np.bool_(False)
+    with pytest.raises(TraitError) as exc:
+        sp.c = False
+    assert exc.value.args[0] == "c should be strictly positive"
+
+
+class CountingExecutor(ThreadPoolExecutor):
+
+    def __init__(self):
+        super(CountingExecutor, self).__init__(max_workers=1)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super(CountingExecutor, self).submit(*args, **kwargs)
+
+
+class TestAsyncValidation(object):
+
+    def setup_method(self, method):
+        self.ap = ArrayProperties()
+        self.changes = []
+        self.ap.observe(self.changes.append, names=['b'])
+        self.executor = CountingExecutor()
+
+    def teardown_method(self, method):
+        self.executor.shutdown()
+
+    def test_valid(self):
+        values = np.ones(1000)
+        result = asyncio.run(avalidate(self.ap, 'b', values, executor=self.executor))
+        assert result is values
+        assert self.ap.b is values
+        assert self.executor.submitted == 1
+        assert len(self.changes) == 1
+        assert self.changes[0]['new'] is values
+
+    def test_invalid(self):
+        self.ap.b = np.ones(3)
+        with pytest.raises(TraitError) as exc:
+            asyncio.run(avalidate(self.ap, 'b', -np.ones(1000), executor=self.executor))
+        assert exc.value.args[0] == "All values of b should be positive"
+        np.testing.assert_equal(self.ap.b, np.ones(3))
+        assert len(self.changes) == 1
+
+    def test_scalar(self):
+        sp = ScalarProperties()
+        asyncio.run(avalidate(sp, 'b', 3., executor=self.executor))
+        assert sp.b == 3.
+        assert self.executor.submitted == 0
+
+    def test_cross_validation(self):
+
+        class Properties(HasTraits):
+            a = NumericalTrait(ndim=1)
+
+            @validate('a')
+            def _check_a(self, proposal):
+                return proposal['value'] * 2
+
+        p = Properties()
+        asyncio.run(avalidate(p, 'a', np.ones(3)))
+        np.testing.assert_equal(p.a, 2.)
+
+    def test_not_numerical(self):
+
+        class Properties(HasTraits):
+            a = Unicode()
+
+        with pytest.raises(TraitError) as exc:
+            asyncio.run(avalidate(Properties(), 'a', 'spam'))
+        assert exc.value.args[0] == "a is not a numerical trait of Properties"
+
+
+class Record(HasTraits):
+
+    mass = NumericalTrait(ndim=0, domain='positive')
+    position = NumericalTrait(shape=(3,), dtype=np.float32, cast=True)
+    label = Unicode()
+
+
+class TestValidateRecords(object):
+
+    def setup_method(self, method):
+        self.records = [{'mass': float(i), 'position': [i, i, i], 'label': str(i)}
+                        for i in range(25)]
+        self.records[7]['mass'] = -1.
+        self.records[12]['position'] = [1, 2]
+        self.records[12]['mass'] = -3.
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_validate_records(self, processes):
+        results = validate_records(Record, self.records, processes=processes, chunk_size=4)
+        assert len(results) == 25
+        assert results[3]['mass'] == 3.
+        assert results[3]['label'] == '3'
+        assert results[3]['position'].dtype == np.float32
+        assert isinstance(results[7], MultipleTraitErrors)
+        assert results[7].errors == {'mass': 'mass should be positive'}
+        assert results[12].errors == {'mass': 'mass should be positive',
+                                      'position': 'position has incorrect length (expected 3 but found 2)'}
+
+    def test_assign_validated(self):
+        results = validate_records(Record, self.records[:3], processes=1)
+        changes = []
+        record = Record()
+        record.observe(changes.append, names=['mass', 'position'])
+        assign_validated(record, results[2])
+        assert record.mass == 2.
+        assert record.label == '2'
+        assert record.position is results[2]['position']
+        assert len(changes) == 2
+
+    def test_pickle_errors(self):
+        import pickle
+        exc = pickle.loads(pickle.dumps(MultipleTraitErrors({'a': 'a is invalid'})))
+        assert exc.errors == {'a': 'a is invalid'}
+        assert exc.args[0] == "1 values failed validation:\n  [a] a is invalid"
+
+
+class TestProfiling(object):
+
+    def setup_method(self, method):
+        reset_profiling()
+        enable_profiling()
+
+    def teardown_method(self, method):
+        disable_profiling()
+        reset_profiling()
+
+    def test_profile(self):
+        sp = ScalarProperties()
+        ap = ArrayProperties()
+        sp.b = 1.
+        sp.b = 2.
+        ap.b = [1.] * 10
+        with pytest.raises(TraitError):
+            ap.b = [-1.] * 10
+        disable_profiling()
+        ap.b = np.ones(10)
+        profile = get_profile()
+        assert sorted(profile) == ['ArrayProperties.b', 'ScalarProperties.b']
+        assert profile['ScalarProperties.b']['scalar']['calls'] == 2
+        stats = profile['ArrayProperties.b']
+        assert sorted(stats) == ['convert', 'domain', 'ndim']
+        assert stats['convert']['calls'] == 2
+        assert stats['convert']['bytes'] == 160
+        assert stats['domain']['calls'] == 2
+        assert stats['domain']['time'] > 0
+        table = profile_table().splitlines()
+        assert table[0].split() == ['trait', 'stage', 'calls', 'time', '(s)', 'bytes']
+        assert len(table) == 5
+
+    def test_cache(self):
+        cp = CachedProperties()
+        values = np.ones(10)
+        for i in range(3):
+            cp.values = values
+        stats = get_profile()['CachedProperties.values']
+        assert stats['cache']['calls'] == 3
+        assert stats['convert']['calls'] == 1
+        assert stats['domain']['calls'] == 1
+
+    def test_bytes_converted(self):
+        ap = ArrayProperties()
+        ap.b = np.ones(10)
+        ap.b = np.ones(10, dtype=np.int32)
+        ap.b = memoryview(np.ones(10))
+        assert get_profile()['ArrayProperties.b']['convert']['bytes'] == 0
+        ap.b = [1., 2.]
+        ap.b = np.ones(10, dtype=object)
+        assert get_profile()['ArrayProperties.b']['convert']['bytes'] == 96
+
+    def test_reset(self):
+        sp = ScalarProperties()
+        sp.b = 1.
+        reset_profiling()
+        assert get_profile() == {}
+
+
+class CachedProperties(HasTraits):
+
+    values = NumericalTrait(ndim=1, domain='positive', cache=True)
+    cast_values = NumericalTrait(ndim=1, dtype=np.float32, cast=True, cache=True)
+
+
+class TestCache(object):
+
+    def setup_method(self, method):
+        self.cp = CachedProperties()
+
+    def test_cached(self):
+        values = np.ones(10)
+        self.cp.values = values
+        values[0] = -1
+        # In-place changes are not detected...
+        self.cp.values = values
+        assert self.cp.values is values
+        # ...unless the array is marked as dirty
+        mark_dirty(values)
+        with pytest.raises(TraitError) as exc:
+            self.cp.values = values
+        assert exc.value.args[0] == "All values of values should be positive"
+
+    def test_layout_changes(self):
+        values = np.ones(10)
+        self.cp.values = values
+        values.shape = (2, 5)
+        with pytest.raises(TraitError) as exc:
+            self.cp.values = values
+        assert exc.value.args[0] == "values should be a 1-d sequence"
+
+    def test_views_not_cached(self):
+        values = np.ones(10)
+        self.cp.values = values
+        values[5] = -1
+        with pytest.raises(TraitError):
+            self.cp.values = values[5:]
+
+    def test_cached_result(self):
+        # Values derived from a cached array are not shared between objects
+        values = np.ones(10)
+        self.cp.cast_values = values
+        first = self.cp.cast_values
+        assert first.dtype == np.float32
+        other = CachedProperties()
+        other.cast_values = values
+        assert other.cast_values is not first
+        assert other.cast_values.dtype == np.float32
+        np.testing.assert_equal(other.cast_values, values)
+
+    def test_cached_result_modified(self):
+        # Changes to a stored copy do not affect later assignments
+        values = np.ones(10)
+        self.cp.cast_values = values
+        self.cp.cast_values[0] = -1
+        other = CachedProperties()
+        other.cast_values = values
+        assert other.cast_values[0] == 1
+
+    def test_cached_checked_once(self):
+        values = np.ones(10)
+        calls = []
+        trait = CachedProperties.cast_values
+        original = trait._validate_value
+        trait._validate_value = lambda value, stats=None, checked=False: calls.append(checked) or original(value, stats, checked)
+        try:
+            for i in range(3):
+                self.cp.cast_values = values
+        finally:
+            del trait._validate_value
+        assert calls == [False, True, True]
+
+    def test_validated_once(self):
+        values = np.ones(10)
+        calls = []
+        trait = CachedProperties.values
+        original = trait._validate_value
+        trait._validate_value = lambda value, stats=None: calls.append(value) or original(value, stats)
+        try:
+            for i in range(3):
+                self.cp.values = values
+        finally:
+            del trait._validate_value
+        assert len(calls) == 1
+
+    def test_forgotten(self):
+        from numtraits import _VALIDATED
+        values = np.ones(10)
+        self.cp.values = values
+        assert id(values) in _VALIDATED
+        key = id(values)
+        self.cp.values = np.ones(3)
+        del values
+        assert key not in _VALIDATED
+
+
+class TestParallel(object):
+
+    def setup_method(self, method):
+        set_num_threads(4)
+
+    def teardown_method(self, method):
+        set_num_threads(None)
+
+    @pytest.mark.parametrize('domain', ['positive', 'strictly-negative', (-1., 1.)])
+    def test_parallel(self, monkeypatch, domain):
+        monkeypatch.setattr('numtraits._PARALLEL_THRESHOLD', 100)
+        trait = NumericalTrait(domain=domain, parallel=True)
+        trait.name = 'a'
+        values = np.full(10000, -0.5 if domain == 'strictly-negative' else 0.5)
+        assert trait.validate(None, values) is values
+        for index in (0, 5000, 9999):
+            invalid = values.copy()
+            invalid[index] = -2 if domain != 'strictly-negative' else 0.
+            with pytest.raises(TraitError):
+                trait.validate(None, invalid)
+
+    def test_parallel_non_contiguous(self, monkeypatch):
+        monkeypatch.setattr('numtraits._PARALLEL_THRESHOLD', 100)
+        trait = NumericalTrait(shape=(100, 50), domain='positive', parallel=True)
+        trait.name = 'a'
+        values = np.ones((100, 100))
+        values[:, 1::2] = -1
+        trait.validate(None, values[:, ::2])
+        values[99, 98] = -1
+        with pytest.raises(TraitError):
+            trait.validate(None, values[:, ::2])
+
+    def test_set_num_threads_concurrent(self, monkeypatch):
+        # Changing the number of threads while other threads are validating
+        # should not break the validation in progress
+        monkeypatch.setattr('numtraits._PARALLEL_THRESHOLD', 100)
+        trait = NumericalTrait(domain='positive', parallel=True)
+        trait.name = 'a'
+        values = np.ones(10000)
+        errors = []
+
+        def validate():
+            try:
+                for i in range(200):
+                    trait.validate(None, values)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=validate) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(200):
+            set_num_threads(1 + i % 4)
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+    def test_invalid_threads(self):
+        with pytest.raises(TraitError) as exc:
+            set_num_threads(0)
+        assert exc.value.args[0] == "n_threads should be at least 1"